@@ -0,0 +1,140 @@
+import boto3
+import botocore
+import hashlib
+import json
+import logging
+import os
+
+import config
+
+from datasets import (
+    get_dataset_version,
+    read_script,
+)
+from metrics import (
+    emit_metric
+)
+
+s3 = boto3.client(
+    "s3",
+    region_name="us-east-1",
+    config=botocore.config.Config(s3={"addressing_style":"path"})
+)
+
+s3_bucket = os.environ["S3_BUCKET_NAME"]
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Bump when the format of a cached output changes to invalidate existing entries
+CACHE_VERSION = 2
+
+# Files in a job's submission directory that make up each stage's output
+CACHED_FILES = {
+    "true_output": ["true_output.csv", "statistic_keys.rds"],
+    "mos_output": ["mos_output.csv"],
+}
+
+
+def hash_inputs(inputs):
+    """
+    Hash a JSON-serializable dictionary of inputs into a cache key.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def get_cache_keys(event):
+    """
+    Compute content-addressed cache keys for a job's stage outputs.
+
+    True values depend only on the script content and the dataset version. MOS
+    inputs also depend on the sampling parameters and sensitivity mode.
+    """
+    dataset_id = event["dataset_id"]
+    script_hash = hashlib.sha256(read_script(event["script_path"]).encode()).hexdigest()
+    true_output_inputs = {
+        "cache_version": CACHE_VERSION,
+        "script_hash": script_hash,
+        "dataset_id": dataset_id,
+        "dataset_version": get_dataset_version(dataset_id),
+    }
+    mos_output_inputs = {
+        **true_output_inputs,
+        "sample_frac": config.SAMPLE_FRAC,
+        "k": config.K,
+        "sensitivity_mode": event.get("sensitivity_mode", config.SENSITIVITY_MODE),
+        "patience": event.get("patience", config.APPROX_PATIENCE_ROWS),
+    }
+    return {
+        "true_output": hash_inputs(true_output_inputs),
+        "mos_output": hash_inputs(mos_output_inputs),
+    }
+
+
+def is_cache_enabled(stage):
+    """
+    Check whether a stage's output may be cached and reused.
+    """
+    if stage == "true_output":
+        return config.CACHE_TRUE_OUTPUT
+    return config.MOS_CACHE_POLICY == "reuse"
+
+
+def get_cache_s3_key(stage, cache_key, filename):
+    """
+    S3 key of a file in a cached stage output.
+    """
+    return f"cache/{stage}/{cache_key}/{filename}"
+
+
+def get_submission_s3_key(job_id, filename):
+    """
+    S3 key of a file in a job's submission directory.
+    """
+    return f"submissions/{job_id}/{filename}"
+
+
+def copy_encrypted_object(source_key, dest_key):
+    """
+    Copy an object within the bucket (server-side, keeping KMS SSE).
+    """
+    s3.copy_object(
+        Bucket=s3_bucket,
+        Key=dest_key,
+        CopySource={"Bucket": s3_bucket, "Key": source_key},
+        ServerSideEncryption="aws:kms",
+    )
+
+
+def restore_cached_output(event, stage):
+    """
+    Copy a cached stage output into the job's submission directory.
+    Returns True on a cache hit (all of the stage's files were cached).
+    """
+    cache_key = event.get("cache_keys", {}).get(stage)
+    if not is_cache_enabled(stage) or cache_key is None:
+        return False
+
+    try:
+        for filename in CACHED_FILES[stage]:
+            copy_encrypted_object(get_cache_s3_key(stage, cache_key, filename), get_submission_s3_key(event["job_id"], filename))
+        hit = True
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise e
+        hit = False
+
+    logger.info(f"Cache {'hit' if hit else 'miss'} for {stage} {cache_key}")
+    emit_metric("CacheHit" if hit else "CacheMiss", 1, dimensions={"Stage": stage}, properties={"job_id": event["job_id"]})
+    return hit
+
+
+def store_cached_output(event, stage):
+    """
+    Copy a job's stage output into the cache.
+    """
+    cache_key = event.get("cache_keys", {}).get(stage)
+    if not is_cache_enabled(stage) or cache_key is None:
+        return
+    for filename in CACHED_FILES[stage]:
+        copy_encrypted_object(get_submission_s3_key(event["job_id"], filename), get_cache_s3_key(stage, cache_key, filename))
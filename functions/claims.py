@@ -0,0 +1,129 @@
+import boto3
+import os
+import threading
+import time
+
+# Cursor items expire a day after a job is dispatched
+CURSOR_TTL_SECS = 86400
+
+
+def get_cursor_id(job_id, subset_index):
+    """
+    Create the ID of a subset's shared work cursor.
+    """
+    return f"{job_id}_{subset_index}"
+
+
+def compute_claim(claimed, max_index, claim_rows):
+    """
+    Convert the cursor position after a claim into the claimed [start, end] rows
+    (R indexes), or None if the subset was already exhausted.
+    """
+    takeout_start_index = claimed - claim_rows + 1
+    if takeout_start_index > max_index:
+        return None
+    takeout_end_index = min(claimed, max_index)
+    return takeout_start_index, takeout_end_index
+
+
+def find_orphaned_claims(claims, claims_done, spawned_messages):
+    """
+    Find the claims a redelivered dynamic task must take out again: the claims
+    after the first claims_done (which its checkpoint covers), less any it
+    already handed over to a continuation task (in spawned_messages).
+    """
+    handed_over = {tuple(c) for m in spawned_messages for c in m.get("orphaned_claims", [])}
+    return [tuple(c) for c in claims[claims_done:] if tuple(c) not in handed_over]
+
+
+class DynamoDBCursorBackend:
+    """
+    Work cursors stored in DynamoDB. Claims are atomic counter increments, so any
+    number of workers can claim rows from the same subset without coordination.
+    increment() uses a cursor as an unbounded counter (created on first use,
+    expiring ttl_secs after its last increment) and adds n to it (which may be
+    negative).
+    """
+
+    def __init__(self, table_name):
+        self.table = boto3.resource("dynamodb", region_name="us-east-1").Table(table_name)
+
+    def reset(self, cursor_id, max_index):
+        self.table.put_item(Item={
+            "cursor_id": cursor_id,
+            "claimed": 0,
+            "max_index": max_index,
+            "expires_at": int(time.time()) + CURSOR_TTL_SECS,
+        })
+
+    def claim(self, cursor_id, claim_rows):
+        response = self.table.update_item(
+            Key={"cursor_id": cursor_id},
+            UpdateExpression="ADD claimed :n",
+            ExpressionAttributeValues={":n": claim_rows},
+            ReturnValues="ALL_NEW",
+        )
+        item = response["Attributes"]
+        return compute_claim(int(item["claimed"]), int(item["max_index"]), claim_rows)
+
+    def is_exhausted(self, cursor_id):
+        item = self.table.get_item(Key={"cursor_id": cursor_id}, ConsistentRead=True)["Item"]
+        return int(item["claimed"]) >= int(item["max_index"])
+
+    def increment(self, cursor_id, ttl_secs=CURSOR_TTL_SECS, n=1):
+        response = self.table.update_item(
+            Key={"cursor_id": cursor_id},
+            UpdateExpression="ADD claimed :n SET expires_at = :expires_at",
+            ExpressionAttributeValues={":n": n, ":expires_at": int(time.time()) + ttl_secs},
+            ReturnValues="UPDATED_NEW",
+        )
+        return int(response["Attributes"]["claimed"])
+
+
+class LocalCursorBackend:
+    """
+    In-process stand-in for DynamoDBCursorBackend, for running workers locally
+    (e.g. several worker threads in one test process).
+    """
+
+    def __init__(self):
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    def reset(self, cursor_id, max_index):
+        with self.lock:
+            self.cursors[cursor_id] = {"claimed": 0, "max_index": max_index}
+
+    def claim(self, cursor_id, claim_rows):
+        with self.lock:
+            cursor = self.cursors[cursor_id]
+            cursor["claimed"] += claim_rows
+            return compute_claim(cursor["claimed"], cursor["max_index"], claim_rows)
+
+    def is_exhausted(self, cursor_id):
+        with self.lock:
+            cursor = self.cursors[cursor_id]
+            return cursor["claimed"] >= cursor["max_index"]
+
+    def increment(self, cursor_id, ttl_secs=CURSOR_TTL_SECS, n=1):
+        with self.lock:
+            cursor = self.cursors.setdefault(cursor_id, {"claimed": 0, "max_index": None})
+            cursor["claimed"] += n
+            return cursor["claimed"]
+
+
+_backend = None
+
+
+def get_cursor_backend():
+    """
+    Get the work cursor backend for this process (DynamoDB unless the
+    WORK_CURSOR_BACKEND environment variable is set to "local").
+    """
+    global _backend
+    if _backend is None:
+        if os.environ.get("WORK_CURSOR_BACKEND", "dynamodb") == "local":
+            _backend = LocalCursorBackend()
+        else:
+            _backend = DynamoDBCursorBackend(os.environ["WORK_CURSOR_TABLE_NAME"])
+    return _backend
@@ -4,8 +4,17 @@ import logging
 import os 
 import pandas as pd
 
+import config
+
+from cache import (
+    store_cached_output
+)
+from storage import (
+    read_csv_from_s3,
+    write_encrypted_csv_to_s3,
+)
 from utils import (
-    write_encrypted_csv_to_s3
+    RUN_INFO_COLUMNS
 )
 
 s3 = boto3.client(
@@ -20,6 +29,10 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# Raised when the workers' outputs don't cover every takeout row 
+class RowsEvaluatedMismatchException(Exception): pass
+
+
 def get_worker_results(job_id): 
     """
     Get all worker results from S3 with a given job_id value. 
@@ -31,21 +44,37 @@ def get_worker_results(job_id):
     pages = paginator.paginate(
         Bucket=s3_bucket, Prefix=f"intermediate/{job_id}/"
     )
-    df_list = [read_csv_from_s3(obj) for page in pages for obj in page["Contents"]] 
-    results_df = pd.concat(df_list)
+    df_list = [
+        read_csv_from_s3(f"s3://{s3_bucket}/{obj['Key']}") for page in pages for obj in page["Contents"]
+    ] 
+    # Keep which output each row came from (the first index level) 
+    results_df = pd.concat(df_list, keys=range(len(df_list)))
     return results_df 
 
 
-def read_csv_from_s3(file):
-    """
-    Read a single csv file from S3. 
+def check_rows_evaluated(results_df, event): 
     """
-    obj = s3.get_object(Bucket=s3_bucket, Key=file["Key"])
-    obj_df = pd.read_csv(obj["Body"])
-    return obj_df
+    Check that the workers took out every row of every subset exactly once, 
+    e.g. that no claimed rows were lost when a worker died. Only exact mode 
+    jobs are checked, since approximate mode workers stop early. 
 
-
-def compute_mos_values(job_id): 
+    A speculative copy of a static task can also take out the rows its original 
+    split off later, so static jobs are only checked for missing rows. 
+    """
+    num_takeout_rows = event.get("num_takeout_rows")
+    if not num_takeout_rows or results_df.empty: 
+        return 
+    if event.get("sensitivity_mode", config.SENSITIVITY_MODE) != "exact": 
+        return 
+    rows_evaluated = int(results_df.groupby(level=0)["rows_evaluated"].first().sum())
+    is_dynamic = event.get("scheduling_mode", config.SCHEDULING_MODE) == "dynamic"
+    if rows_evaluated < num_takeout_rows or (is_dynamic and rows_evaluated > num_takeout_rows): 
+        raise RowsEvaluatedMismatchException(
+            f"Workers evaluated {rows_evaluated} rows, expected {num_takeout_rows}"
+        )
+
+
+def compute_mos_values(event): 
     """
     Compute maximum observed sensitivity (MOS) for all statistics. 
 
@@ -54,11 +83,12 @@ def compute_mos_values(job_id):
         ls = local sensitivity 
     """
     # Compute MOS values 
-    results_df = get_worker_results(job_id)
+    results_df = get_worker_results(event["job_id"])
+    check_rows_evaluated(results_df, event)
+    results_df.drop(columns=RUN_INFO_COLUMNS, errors="ignore", inplace=True)
     results_df["chi"] = results_df["n"] * results_df["ls"] 
-    group_cols = [c for c in results_df.columns if c not in ("n", "ls", "chi")]
-    mos_df = results_df.sort_values("chi", ascending=False).drop_duplicates(group_cols)
-    mos_df.drop(columns = ["n", "ls"], inplace=True)
+    mos_df = results_df.sort_values("chi", ascending=False).drop_duplicates("stat_key")
+    mos_df = mos_df.set_index("stat_key")[["chi"]]
     return mos_df 
 
 
@@ -67,23 +97,23 @@ def get_true_values(job_id):
     Read csv with true values (without noise added) from S3 (created by dispatcher). 
     """
     s3_path = f"s3://{s3_bucket}/submissions/{job_id}/true_output.csv"
-    true_values_df = pd.read_csv(s3_path)
+    true_values_df = read_csv_from_s3(s3_path)
     return true_values_df
 
 
-def prep_combined_output(job_id): 
+def prep_combined_output(event): 
     """ 
     Generate MOS formula inputs that are constant across runs.    
     """
-    # Merge MOS values with true values 
-    mos_df = compute_mos_values(job_id)
+    job_id = event["job_id"]
+
+    # Join MOS values with true values (statistic keys are true output row indexes)
+    mos_df = compute_mos_values(event)
     true_values_df = get_true_values(job_id)
-    merge_cols = [c for c in true_values_df.columns if c not in ("n", "value")] 
-    combined_df = pd.merge(true_values_df, mos_df, how="left", on=merge_cols)
+    combined_df = true_values_df.join(mos_df)
 
     # Add ID column for each statistic 
-    statistic_id_col = combined_df.reset_index().index
-    combined_df.insert(0, "statistic_id", statistic_id_col)
+    combined_df.insert(0, "statistic_id", combined_df.index)
 
     # Add ID column for each analysis 
     analysis_id_col = combined_df.groupby(['analysis_name', 'analysis_type']).ngroup()
@@ -103,8 +133,12 @@ def write_combined_output_to_s3(output_df, job_id):
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
     job_id = event["job_id"]
-    combined_df = prep_combined_output(job_id)
-    write_combined_output_to_s3(combined_df, job_id)
+
+    # MOS inputs were restored from the cache by the dispatcher 
+    if not event.get("mos_cached"): 
+        combined_df = prep_combined_output(event)
+        write_combined_output_to_s3(combined_df, job_id)
+        store_cached_output(event, "mos_output")
     return {
         **event, 
         "use_default_epsilon": True
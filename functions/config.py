@@ -2,4 +2,63 @@
 SAMPLE_FRAC = 0.01      # Fraction of the full dataset to sample 
 K = 10                  # Number of subsets to split the full dataset into 
 DEFAULT_EPSILON = 1.0   # Default epsilon value per job (equally divided across rows)
-N_THRESHOLD = 10        # Suppress results with cell sizes less than or equal to this threshold 
\ No newline at end of file
+N_THRESHOLD = 10        # Suppress results with cell sizes less than or equal to this threshold 
+
+# Dataset reading
+PRUNE_COLUMNS = True                # Only read the dataset columns referenced by the user script
+USE_DATASET_SNAPSHOTS = True        # Load the full dataset from a cached fst snapshot instead of the csv
+SNAPSHOT_DIR = "/tmp/snapshots"     # Container cache for dataset snapshots
+
+# Task scheduling
+SCHEDULING_MODE = "static"          # "static" takeout ranges per task or "dynamic" work claiming
+CLAIM_CHUNK_ROWS = 10               # Rows a worker claims at a time in dynamic mode
+
+# Local sensitivity computation
+SENSITIVITY_MODE = "exact"          # "exact" or "approximate" (influence-ordered takeouts with early stopping)
+APPROX_PATIENCE_ROWS = 200          # Consecutive rows without a new max before an approximate run stops
+
+# Result caching (keyed on script content, dataset version and the parameters above)
+CACHE_TRUE_OUTPUT = True            # Reuse true values from identical earlier submissions
+MOS_CACHE_POLICY = "off"            # "reuse" MOS inputs from identical earlier submissions or "off"
+
+# Worker checkpointing
+TAKEOUT_CHUNK_ROWS = 25             # Rows taken out between checkpoint checks
+CHECKPOINT_INTERVAL_SECS = 60       # Minimum time between checkpoints of a task's progress
+
+# Worker deadlines
+MAX_SECS_PER_TASK = 840             # Target task duration (900 sec Lambda limit; workers split off unfinished work)
+DEADLINE_BUFFER_SECS = 30           # Time a worker keeps in reserve to write output and split off its remaining rows
+
+# Job progress
+PROGRESS_INTERVAL_SECS = 30         # How often workers record the rows they've processed
+
+# Straggler re-dispatch (static tasks only)
+STRAGGLER_FACTOR = 3                # Re-dispatch a copy of tasks running this many times the job's median task duration
+STRAGGLER_MIN_COMPLETED_TASKS = 5   # Completed tasks needed before the job's median duration is used
+STRAGGLER_MIN_SECS = 60             # Never re-dispatch tasks that have run for less than this
+
+# Job scheduling
+MAX_IN_FLIGHT_TASKS_PER_JOB = 100   # Tasks a job may have queued or running at once (None for no limit)
+PRIORITY_WEIGHTS = {"high": 4, "normal": 2, "low": 1}   # Relative share of the workers a job of each priority gets
+HIGH_PRIORITY_MAX_TASKS = 50        # Jobs with at most this many tasks run at high priority
+LOW_PRIORITY_MIN_TASKS = 500        # Jobs with at least this many tasks run at low priority
+MAX_JOB_TIMEOUT_SECS = 41400        # Cap on a job's timeout (below the state machine's 43200 sec TimeoutSeconds)
+
+# Subset pool (pre-sampled, pre-split subsets reused across jobs)
+SUBSET_POOL_POLICY = "off"          # "off" (sample per job), "rotate" through the pool's sets or pick one at "random"
+POOL_DATASETS = ["cps", "puf_2012"] # Datasets the scheduled refresh builds pools for
+POOL_SIZE = 4                       # Subset sets kept per dataset
+POOL_SETS_PER_REFRESH = 1           # New sets built (replacing the oldest) per scheduled refresh
+POOL_SET_MAX_USES = 25              # Jobs a pooled set serves, since every job on it reuses the same sample (None for no limit)
+POOL_SET_MAX_AGE_SECS = 864000      # Sets older than this aren't used (the pools/ lifecycle rule deletes them after 14 days)
+SUBSET_CACHE_DIR = "/tmp/subsets"   # Worker cache for pool subsets
+SUBSET_CACHE_MAX_FILES = 20         # Pool subsets kept in a worker's /tmp
+SUBSET_CACHE_MAX_FRAMES = 2         # Pool subsets kept loaded in a worker's R session
+
+# S3 csv writes
+SUBSET_COMPRESSION = "gzip"         # None or "gzip" (subsets are read by R, which can't read zstd)
+INTERMEDIATE_COMPRESSION = "gzip"   # None, "gzip" or "zstd" for worker outputs
+GZIP_LEVEL = 6                      # gzip compression level (1-9)
+ZSTD_LEVEL = 3                      # zstd compression level (1-22)
+CSV_CHUNK_ROWS = 50000              # Rows serialized at a time when streaming a csv to S3
+S3_WRITE_BLOCK_BYTES = 8 * 2**20    # Multipart upload part size (S3 minimum is 5 MiB)
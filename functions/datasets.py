@@ -0,0 +1,230 @@
+import boto3
+import botocore
+import json
+import logging
+import os
+
+import pandas as pd
+
+import config 
+
+from script_columns import (
+    find_script_columns
+)
+
+s3 = boto3.client(
+    "s3",
+    region_name="us-east-1",
+    config=botocore.config.Config(s3={"addressing_style":"path"})
+)
+
+s3_bucket = os.environ["S3_BUCKET_NAME"]
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Registry of confidential datasets. Each dataset's schema (column names, dtypes,
+# row count and file layout) is stored as JSON next to the raw file. It is built
+# from a single full read when the dataset is registered (see register.py), never
+# during a job.
+DATASET_REGISTRY = {
+    "cps": {
+        "dataset_s3_key": "data/cps_2022-2023.csv",
+        "schema_s3_key": "data/cps_2022-2023.schema.json",
+    },
+    "puf_2012": {
+        "dataset_s3_key": "data/puf_2012.csv",
+        "schema_s3_key": "data/puf_2012.schema.json",
+    },
+    "puf_2012_subset": {
+        "dataset_s3_key": "data/puf_2012_subset.csv",
+        "schema_s3_key": "data/puf_2012_subset.schema.json",
+    },
+}
+
+# Bumped when the schema's contents change, so registration rebuilds older schemas
+# (2: R classes inferred by R rather than mapped from pandas dtypes)
+SCHEMA_FORMAT = 2
+
+_schema_cache = {}
+
+
+def get_dataset_metadata(dataset_id):
+    """
+    Get dictionary with metadata info from dataset name.
+    """
+    entry = DATASET_REGISTRY[dataset_id]
+    metadata = {
+        "dataset_id": dataset_id,
+        "dataset_s3_uri": f"s3://{s3_bucket}/{entry['dataset_s3_key']}",
+        "schema_s3_uri": f"s3://{s3_bucket}/{entry['schema_s3_key']}",
+    }
+    return metadata
+
+
+def get_dataset_version(dataset_id):
+    """
+    Get the version of a dataset's raw file (S3 ETag).
+    """
+    entry = DATASET_REGISTRY[dataset_id]
+    response = s3.head_object(Bucket=s3_bucket, Key=entry["dataset_s3_key"])
+    return response["ETag"].strip('"')
+
+
+def build_dataset_schema(dataset_id, version, r_classes):
+    """
+    Read a raw dataset once (inferring types from the whole file) and describe
+    its columns, dtypes, row count and file layout. pandas dtypes are used by
+    the pandas readers; R classes (inferred by R itself, see
+    rsession.get_dataset_r_classes()) by read.csv.
+    """
+    metadata = get_dataset_metadata(dataset_id)
+    df = pd.read_csv(metadata["dataset_s3_uri"])
+    schema = {
+        "dataset_id": dataset_id,
+        "version": version,
+        "format": SCHEMA_FORMAT,
+        "n_rows": df.shape[0],
+        "file_format": "csv",
+        "delimiter": ",",
+        "header": True,
+        "columns": [
+            {"name": col, "dtype": str(df[col].dtype), "r_class": r_classes[col]}
+            for col in df.columns
+        ],
+    }
+    return schema
+
+
+def write_dataset_schema(dataset_id, schema):
+    """
+    Write a dataset's schema JSON to S3.
+    """
+    entry = DATASET_REGISTRY[dataset_id]
+    s3.put_object(
+        Bucket=s3_bucket,
+        Key=entry["schema_s3_key"],
+        Body=json.dumps(schema).encode(),
+        ServerSideEncryption="aws:kms",
+    )
+
+
+def read_dataset_schema(dataset_id):
+    """
+    Read a dataset's schema JSON from S3 (None if it hasn't been built yet).
+    """
+    entry = DATASET_REGISTRY[dataset_id]
+    try:
+        obj = s3.get_object(Bucket=s3_bucket, Key=entry["schema_s3_key"])
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(obj["Body"].read())
+
+
+def is_dataset_schema_current(dataset_id, version):
+    """
+    Check whether a dataset's stored schema was built from this version of
+    the raw file, in the current schema format.
+    """
+    schema = read_dataset_schema(dataset_id)
+    return schema is not None and schema["version"] == version and schema.get("format") == SCHEMA_FORMAT
+
+
+def get_dataset_schema(dataset_id):
+    """
+    Get the schema of the current version of a dataset, or None if it hasn't 
+    been registered yet (jobs then read every column and let pandas and R infer 
+    the column types). Cached for the life of the container.
+    """
+    if dataset_id in _schema_cache:
+        return _schema_cache[dataset_id]
+
+    version = get_dataset_version(dataset_id)
+    schema = read_dataset_schema(dataset_id)
+    if schema is None or schema["version"] != version or schema.get("format") != SCHEMA_FORMAT:
+        logger.warning(f"Dataset {dataset_id} (version {version}) has no registered schema")
+        return None
+
+    _schema_cache[dataset_id] = schema
+    return schema
+
+
+def parse_s3_uri(s3_uri):
+    """
+    Split an s3://bucket/key URI into its bucket and key.
+    """
+    bucket, key = s3_uri.replace("s3://", "", 1).split("/", 1)
+    return bucket, key
+
+
+def read_script(script_s3_uri):
+    """
+    Read the text of a user-submitted R script from S3.
+    """
+    bucket, key = parse_s3_uri(script_s3_uri)
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    return obj["Body"].read().decode("utf-8", errors="replace")
+
+
+def get_script_columns(script_s3_uri, dataset_id):
+    """
+    Determine which dataset columns an R script references.
+
+    Returns None (read every column) if the dataset has no registered schema or 
+    the columns can't be safely determined (see script_columns.find_script_columns()).
+    """
+    schema = get_dataset_schema(dataset_id)
+    if schema is None:
+        return None
+
+    script = read_script(script_s3_uri)
+    columns = find_script_columns(script, [c["name"] for c in schema["columns"]])
+    if columns is None:
+        logger.info("Script's columns can't be determined statically, reading all columns")
+        return None
+
+    logger.info(f"Reading {len(columns)} of {len(schema['columns'])} columns: {columns}")
+    return columns
+
+
+def get_analysis_columns(script_s3_uri, dataset_id):
+    """
+    Get the dataset columns a job needs to read (None for all columns).
+    """
+    if not config.PRUNE_COLUMNS:
+        return None
+    return get_script_columns(script_s3_uri, dataset_id)
+
+
+def get_read_csv_kwargs(dataset_id, columns=None):
+    """
+    Get pd.read_csv arguments with explicit dtypes (and column pruning when
+    columns are given) for a dataset or a subset of it.
+    """
+    schema = get_dataset_schema(dataset_id)
+    if schema is None:
+        return {"usecols": columns}
+    dtypes = {
+        c["name"]: c["dtype"] for c in schema["columns"]
+        if columns is None or c["name"] in columns
+    }
+    return {"dtype": dtypes, "usecols": columns}
+
+
+def get_r_col_classes(dataset_id, columns=None, drop_unused=True):
+    """
+    Get R read.csv colClasses for a dataset. Unused columns are mapped to "NULL"
+    (skipped by read.csv) when reading the full dataset, and left out when reading
+    a subset that only contains the selected columns. None (let read.csv infer
+    the classes) if the dataset has no registered schema.
+    """
+    schema = get_dataset_schema(dataset_id)
+    if schema is None:
+        return None
+    col_classes = {}
+    for c in schema["columns"]:
+        if columns is None or c["name"] in columns:
+            col_classes[c["name"]] = c["r_class"]
+        elif drop_unused:
+            col_classes[c["name"]] = "NULL"
+    return col_classes
@@ -1,7 +1,6 @@
 import boto3
 import botocore 
 import datetime
-import json
 import logging
 import math
 import numpy as np
@@ -11,10 +10,36 @@ import time
 
 import config 
 
-from utils import (
+from cache import (
+    restore_cached_output
+)
+from claims import (
+    get_cursor_backend,
+    get_cursor_id,
+)
+from datasets import (
+    get_analysis_columns,
     get_dataset_metadata,
-    get_local_sensitivities_df,  
-    write_encrypted_csv_to_s3
+    get_r_col_classes,
+    get_read_csv_kwargs,
+)
+from storage import (
+    add_compression_extension,
+    write_encrypted_csv_to_s3,
+)
+from subset_pool import (
+    choose_pool_set,
+    get_subset_path,
+)
+from tasks import (
+    compute_job_timeout_secs,
+    generate_task_id,
+    get_job_in_flight_budget,
+    submit_tasks,
+)
+from rsession import (
+    get_local_sensitivities_df,
+    save_baseline,
 )
 
 s3 = boto3.client(
@@ -22,23 +47,27 @@ s3 = boto3.client(
     region_name="us-east-1", 
     config=botocore.config.Config(s3={"addressing_style":"path"})
 )
-sqs = boto3.client("sqs")
 
 s3_bucket = os.environ["S3_BUCKET_NAME"]
-sqs_queue = os.environ["TASK_QUEUE_NAME"]
-sqs_queue_url = f"https://sqs.us-east-1.amazonaws.com/672001523455/{sqs_queue}"
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Worker sizing test parameter (semi-arbitrary)
+TAKEOUT_ROWS_TO_TEST = 20   # Decide how many rows to test 
 
-def load_confidential_data(event): 
+# Time kept in reserve for dispatching tasks after saving the subsets' baselines 
+BASELINE_BUFFER_SECS = 60 
+
+
+def load_confidential_data(event, columns=None): 
     """
     Read confidential data from S3. 
     """
-    metadata = get_dataset_metadata(event["dataset_id"])
+    dataset_id = event["dataset_id"]
+    metadata = get_dataset_metadata(dataset_id)
     dataset_s3_uri = metadata["dataset_s3_uri"]
-    df = pd.read_csv(dataset_s3_uri)
+    df = pd.read_csv(dataset_s3_uri, **get_read_csv_kwargs(dataset_id, columns))
     return df 
 
 
@@ -47,16 +76,29 @@ def write_subset_to_s3(subset, job_id, dataset_id, subset_index):
     Write csv dataset subset to S3. 
     """
     s3_path = f"s3://{s3_bucket}/subsets/{job_id}/{dataset_id}_{subset_index}.csv"
-    write_encrypted_csv_to_s3(subset, s3_path)
+    s3_path = add_compression_extension(s3_path, config.SUBSET_COMPRESSION)
+    write_encrypted_csv_to_s3(subset, s3_path, compression=config.SUBSET_COMPRESSION)
     return s3_path
 
 
-def generate_task_id(dataset_id, subset_index, takeout_start_index, takeout_end_index):
+def write_subsets_to_s3(sampled_df, job_id, dataset_id): 
+    """
+    Shard the sampled data into k subsets (drawing without replacement) and 
+    write them to S3. Returns the (S3 path, number of rows) of each subset. 
+    """
+    df_subsets = np.array_split(sampled_df, config.K)
+    return [
+        (write_subset_to_s3(subset, job_id, dataset_id, subset_index), subset.shape[0]) 
+        for subset_index, subset in enumerate(df_subsets)
+    ]
+
+
+def get_baseline_s3_uri(job_id, dataset_id, subset_index): 
     """
-    Create unique task ID for a worker. 
+    S3 path of a subset's baseline (the script's estimates on the full subset), 
+    shared by all of the subset's tasks. 
     """
-    id = f"{dataset_id}_{subset_index}_{takeout_start_index}_{takeout_end_index}"
-    return id
+    return f"s3://{s3_bucket}/subsets/{job_id}/{dataset_id}_{subset_index}_baseline.rds"
 
 
 def compute_takeout_end_index(takeout_start_index, max_index, workers_per_k):
@@ -68,88 +110,178 @@ def compute_takeout_end_index(takeout_start_index, max_index, workers_per_k):
     return takeout_end_index
 
 
-def compute_workers_per_k(df, k, job_id, dataset_id, script_s3_uri): 
+def compute_min_workers_per_k(rows_per_k, elapsed_secs):
     """
-    Compute minimum number of workers to assign to each subset to avoid hitting 
-    the 900 seconds Lambda timeout (using 720 seconds for a buffer) based on the 
-    time it takes to process 20 rows. 
+    Compute minimum number of workers required to process each subset given 
+    the time it took to process TAKEOUT_ROWS_TO_TEST rows. 
     """
-    # Define test parameters (semi-arbitrary)
-    max_secs_per_worker = 720 # 900 sec (Lambda limit) - 180 sec (buffer)
-    takeout_rows_to_test = 20 # Decide how many rows to test 
-
-    # Create a sample subset with the same number of rows as a real subset 
-    test_df = df.sample(frac = 1/k)
-    rows_per_k = test_df.shape[0]
-    test_s3_path = write_subset_to_s3(test_df, job_id, dataset_id, "_")
-    
-    # Time how long it takes to process 20 rows 
-    t0 = time.time()
-    get_local_sensitivities_df(script_s3_uri, test_s3_path, 1, takeout_rows_to_test)
-    t1 = time.time()
-    elapsed_secs = t1 - t0 
-
     # Compute maximum number of rows a worker can process 
-    max_rows_per_worker = max_secs_per_worker * takeout_rows_to_test / elapsed_secs 
+    max_rows_per_worker = config.MAX_SECS_PER_TASK * TAKEOUT_ROWS_TO_TEST / elapsed_secs 
 
     # Compute minimum number of workers required to process each subset 
     min_workers_per_k = math.ceil(rows_per_k / max_rows_per_worker)
     return min_workers_per_k
 
 
-def dispatch_task(job_id, dataset_id, subset_index, subset_s3_path, script_s3_uri, takeout_start_index, takeout_end_index):
+def time_test_rows(script_s3_uri, subset_path, col_classes=None, baseline_s3_uri=None): 
+    """
+    Time how long it takes to process TAKEOUT_ROWS_TO_TEST rows of a subset 
+    (loading its baseline from baseline_s3_uri, as its tasks do). 
     """
-    Dispatch a single worker task as an SQS message. 
+    t0 = time.time()
+    get_local_sensitivities_df(
+        script_s3_uri, subset_path, 1, TAKEOUT_ROWS_TO_TEST, col_classes, baseline_s3_uri=baseline_s3_uri
+    )
+    t1 = time.time()
+    return t1 - t0 
+
+
+def compute_workers_per_k(event, subsets, context, col_classes=None): 
+    """
+    Compute minimum number of workers to assign to each subset to avoid hitting 
+    the 900 seconds Lambda timeout (targeting MAX_SECS_PER_TASK seconds) based on 
+    the time it takes to process 20 rows of the first subset. 
+
+    Also saves every subset's baseline, so all of a subset's tasks (which start 
+    together) load it instead of each fitting it. The baselines of the other 
+    subsets are only saved if fitting them leaves BASELINE_BUFFER_SECS of the 
+    Lambda's remaining time. Otherwise their tasks fit them, so the time it 
+    took to fit the first subset's baseline is added to the calibration. 
+    """
+    job_id = event["job_id"]
+    dataset_id = event["dataset_id"]
+    script_s3_uri = event["script_path"]
+    subset_paths = [get_subset_path(subset_s3_path) for subset_s3_path, _ in subsets]
+    baseline_s3_uris = [get_baseline_s3_uri(job_id, dataset_id, i) for i in range(len(subsets))]
+
+    t0 = time.time()
+    save_baseline(script_s3_uri, subset_paths[0], col_classes, baseline_s3_uris[0])
+    baseline_secs = time.time() - t0
+    elapsed_secs = time_test_rows(script_s3_uri, subset_paths[0], col_classes, baseline_s3_uris[0])
+
+    remaining_secs = context.get_remaining_time_in_millis() / 1000 
+    if (len(subsets) - 1) * baseline_secs < remaining_secs - BASELINE_BUFFER_SECS: 
+        for subset_path, baseline_s3_uri in zip(subset_paths[1:], baseline_s3_uris[1:]): 
+            save_baseline(script_s3_uri, subset_path, col_classes, baseline_s3_uri)
+    else: 
+        logger.warning(f"Not enough time to save {len(subsets) - 1} baselines ({baseline_secs:.1f} secs each), leaving them to the workers")
+        elapsed_secs += baseline_secs
+
+    rows_per_k = max(max_index for _, max_index in subsets)
+    return compute_min_workers_per_k(rows_per_k, elapsed_secs)
+
+
+def get_sensitivity_options(event): 
+    """
+    Get the local sensitivity mode for a job's workers ("exact" or "approximate", 
+    which can be requested per job) and the early stopping patience. 
+    """
+    return {
+        "sensitivity_mode": event.get("sensitivity_mode", config.SENSITIVITY_MODE),
+        "patience": event.get("patience", config.APPROX_PATIENCE_ROWS),
+    }
+
+
+def build_task(job_id, dataset_id, subset_index, subset_s3_path, script_s3_uri, takeout_start_index, takeout_end_index, columns=None, sensitivity_options=None, baseline_s3_uri=None):
+    """
+    Build the SQS message for a single worker task. 
     """
     task_id = generate_task_id(dataset_id, subset_index, takeout_start_index, takeout_end_index)
     message = {
         "job_id": job_id,
         "task_id": task_id,
+        "dataset_id": dataset_id,
+        "columns": columns,
         "subset_s3_uri": subset_s3_path,
         "script_s3_uri": script_s3_uri,
         "takeout_start_index": takeout_start_index,
         "takeout_end_index": takeout_end_index,
+        "baseline_s3_uri": baseline_s3_uri,
+        **(sensitivity_options or {}),
     }
-    response = sqs.send_message(QueueUrl=sqs_queue_url, MessageBody=json.dumps(message))
-    return response 
+    return message
 
 
-def dispatch_all_tasks(event):
+def build_dynamic_task(job_id, dataset_id, subset_index, subset_s3_path, script_s3_uri, worker_index, cursor_id, columns=None, sensitivity_options=None, baseline_s3_uri=None):
     """
-    Dispatch all worker tasks by randomly sampling from the full confidential 
-    dataset, sharding the sample into k subsets (drawing without replacement), 
-    splitting the subsets into smaller tasks by specifying takeout rows, and  
-    dispatching messages to SQS with each task. 
+    Build the SQS message for a single worker task that claims rows from the 
+    subset's shared cursor until the subset is exhausted. 
     """
-    # Parse submission info
-    dataset_id = event["dataset_id"]
-    job_id = event["job_id"]
-    script_s3_uri = event["script_path"]
-    sample_frac = config.SAMPLE_FRAC
-    k = config.K 
+    task_id = f"{dataset_id}_{subset_index}_w{worker_index}"
+    message = {
+        "job_id": job_id,
+        "task_id": task_id,
+        "dataset_id": dataset_id,
+        "columns": columns,
+        "subset_s3_uri": subset_s3_path,
+        "script_s3_uri": script_s3_uri,
+        "schedule": "dynamic",
+        "cursor_id": cursor_id,
+        "claim_rows": config.CLAIM_CHUNK_ROWS,
+        "baseline_s3_uri": baseline_s3_uri,
+        **(sensitivity_options or {}),
+    }
+    return message
 
-    # Sample from full dataset
-    # Note: Setting sample_frac = 1.0 randomly shuffles the full dataset
-    df = load_confidential_data(event)
-    sampled_df = df.sample(frac=sample_frac)
 
-    # Compute number of workers to assign to each subset  
-    workers_per_k = compute_workers_per_k(sampled_df, k, job_id, dataset_id, script_s3_uri)
+def build_dynamic_tasks(event, subset_index, subset_s3_path, max_index, workers_per_k, columns=None, sensitivity_options=None, baseline_s3_uri=None): 
+    """
+    Reset a subset's shared cursor and build workers_per_k tasks that claim 
+    rows from it. 
+    """
+    cursor_id = get_cursor_id(event["job_id"], subset_index)
+    get_cursor_backend().reset(cursor_id, max_index)
+    messages = [] 
+    for worker_index in range(workers_per_k): 
+        message = build_dynamic_task(
+            event["job_id"],
+            event["dataset_id"],
+            subset_index,
+            subset_s3_path,
+            event["script_path"],
+            worker_index,
+            cursor_id,
+            columns,
+            sensitivity_options,
+            baseline_s3_uri,
+        )
+        messages.append(message)
+    return messages
+
+
+def dispatch_subsets(event, subsets, workers_per_k, columns=None): 
+    """
+    Split the subsets (list of S3 path and number of rows) into smaller tasks 
+    by specifying takeout rows, and submit the job's tasks to SQS (see 
+    tasks.submit_tasks() for how they are prioritized and throttled). 
 
-    # Split into subsets
-    df_subsets = np.array_split(sampled_df, k)
+    In dynamic scheduling mode, subsets aren't split into fixed ranges. Instead, 
+    workers_per_k workers per subset claim small chunks of rows from a shared 
+    cursor until the subset is exhausted. 
 
-    # Write subsets to S3 and dispatch SQS tasks
-    num_tasks = 0 
-    for subset_index, subset in enumerate(df_subsets):
-        subset_s3_path = write_subset_to_s3(subset, job_id, dataset_id, subset_index)
+    Returns the number of tasks dispatched and the number of rows they take out. 
+    """
+    dataset_id = event["dataset_id"]
+    job_id = event["job_id"]
+    script_s3_uri = event["script_path"]
+    scheduling_mode = event.get("scheduling_mode", config.SCHEDULING_MODE)
+    sensitivity_options = get_sensitivity_options(event)
+
+    # Build SQS tasks for each subset
+    messages = [] 
+    for subset_index, (subset_s3_path, max_index) in enumerate(subsets):
+        baseline_s3_uri = get_baseline_s3_uri(job_id, dataset_id, subset_index)
+        if scheduling_mode == "dynamic": 
+            messages += build_dynamic_tasks(
+                event, subset_index, subset_s3_path, max_index, workers_per_k, columns, sensitivity_options, baseline_s3_uri
+            )
+            continue 
 
         # Continue dispatching tasks until all rows in the subset have been assigned
-        max_index = subset.shape[0] 
         takeout_start_index = takeout_end_index = 1 # R starts indexing at 1 (not 0)!  
         while takeout_end_index < max_index: 
             takeout_end_index = compute_takeout_end_index(takeout_start_index, max_index, workers_per_k)
-            dispatch_task(
+            message = build_task(
                 job_id,
                 dataset_id,
                 subset_index,
@@ -157,31 +289,91 @@ def dispatch_all_tasks(event):
                 script_s3_uri,
                 takeout_start_index,
                 takeout_end_index,
+                columns,
+                sensitivity_options,
+                baseline_s3_uri,
             )
+            messages.append(message)
             takeout_start_index = takeout_end_index + 1
-            num_tasks += 1 
     
-    return num_tasks
+    num_takeout_rows = sum(max_index for _, max_index in subsets)
+    return submit_tasks(event, messages), num_takeout_rows
 
 
-def update_state_machine(event, num_tasks): 
+def dispatch_all_tasks(event, context):
     """
-    Update state machine payload with job monitoring parameters. 
+    Dispatch all worker tasks by randomly sampling from the full confidential 
+    dataset, sizing tasks from a timed test run on the first subset, and 
+    dispatching the subsets. 
+
+    If the subset pool is enabled and has a set for the dataset, the job uses 
+    that set's subsets instead of reading and sampling the dataset. 
+    """
+    # Parse submission info
+    dataset_id = event["dataset_id"]
+    job_id = event["job_id"]
+    script_s3_uri = event["script_path"]
+    sample_frac = config.SAMPLE_FRAC
+
+    # Only read the columns referenced by the script 
+    columns = get_analysis_columns(script_s3_uri, dataset_id)
+    col_classes = get_r_col_classes(dataset_id, columns, drop_unused=False)
+
+    # Reuse pre-sampled subsets from the pool 
+    pool_set = choose_pool_set(dataset_id, event.get("subset_pool_policy", config.SUBSET_POOL_POLICY))
+    if pool_set is not None: 
+        logger.info(f"Using pooled subset set {pool_set['set_id']}")
+        subsets = list(zip(pool_set["subset_s3_uris"], pool_set["subset_rows"]))
+        workers_per_k = compute_workers_per_k(event, subsets, context, col_classes)
+        return dispatch_subsets(event, subsets, workers_per_k, columns)
+
+    # Sample from full dataset
+    # Note: Setting sample_frac = 1.0 randomly shuffles the full dataset
+    df = load_confidential_data(event, columns)
+    sampled_df = df.sample(frac=sample_frac)
+
+    subsets = write_subsets_to_s3(sampled_df, job_id, dataset_id)
+
+    # Compute number of workers to assign to each subset  
+    workers_per_k = compute_workers_per_k(event, subsets, context, col_classes)
+    return dispatch_subsets(event, subsets, workers_per_k, columns)
+
+
+def update_state_machine(event, num_tasks, num_takeout_rows=0): 
+    """
+    Update state machine payload with job monitoring parameters (the monitor 
+    reports progress against num_takeout_rows). 
+
+    Jobs with more tasks than their in-flight budget (their share of the 
+    workers given the jobs already running) run their tasks in waves, so the 
+    job timeout allows for each wave. The monitor extends it if jobs submitted 
+    later shrink the budget. 
     """
     start_time = datetime.datetime.now()
     start_ftime = start_time.strftime('%Y-%m-%dT%H-%M-%S')
-    job_timeout_secs = int(os.environ["JOB_TIMEOUT_SECS"])
+    in_flight_budget = get_job_in_flight_budget(event["job_id"]) if num_tasks else 1 
+    job_timeout_secs = compute_job_timeout_secs(num_tasks, in_flight_budget)
     
     return {
         **event, 
         "start_time": start_ftime, 
         "job_timeout_secs": job_timeout_secs, 
-        "num_tasks_dispatched": num_tasks       
+        "num_tasks_dispatched": num_tasks, 
+        "num_takeout_rows": num_takeout_rows 
     }
 
 
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
-    num_tasks = dispatch_all_tasks(event)
-    payload = update_state_machine(event, num_tasks)
+
+    # Skip the workers entirely if the MOS inputs can be reused 
+    if restore_cached_output(event, "mos_output"): 
+        payload = update_state_machine(event, 0)
+        return {
+            **payload, 
+            "mos_cached": True
+        }
+
+    num_tasks, num_takeout_rows = dispatch_all_tasks(event, context)
+    payload = update_state_machine(event, num_tasks, num_takeout_rows)
     return payload 
@@ -1,8 +1,12 @@
 import logging
 
-from utils import (
-    send_email_to_user, 
-    update_job_status
+from outbox import (
+    record_email, 
+    record_job_status, 
+    sends_notifications
+)
+from progress import (
+    deregister_active_job
 )
 
 logger = logging.getLogger()
@@ -15,12 +19,16 @@ def send_failure_email(event):
     """
     subject = "Validation Server Job Status" 
     body = "There was an error processing your submission."
-    send_email_to_user(event, subject, body)
+    record_email(event, subject, body)
 
 
+@sends_notifications
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
 
+    # Free the failed job's share of the workers for the jobs still running 
+    deregister_active_job(event["job_id"])
+
     if event["error"]["Error"] == "RRuntimeError": 
         result = {
             "ok": False, 
@@ -39,6 +47,6 @@ def lambda_handler(event, context):
             "errormsg": "Encountered unexpected error."
         }
         
-    update_job_status(event, result)
+    record_job_status(event, result)
     send_failure_email(event)
 
@@ -0,0 +1,100 @@
+"""
+Report how long each Lambda handler module takes to import (the part of a cold
+start spent in our code and its dependencies, before the first invocation).
+
+Run from this directory inside the function image (or any environment with the
+requirements installed):
+
+    python import_report.py [handler ...]
+
+Uses `python -X importtime` in a fresh interpreter per handler and prints the
+total import time along with the handler's slowest direct imports.
+"""
+import os
+import subprocess
+import sys
+
+HANDLERS = [
+    "error",
+    "notifier",
+    "monitor",
+    "combiner",
+    "sanitizer",
+    "validator",
+    "dispatcher",
+    "validate_dispatch",
+    "worker",
+    "subset_pool",
+    "register",
+]
+
+# Handlers read these at import time; the values are only placeholders
+PLACEHOLDER_ENV = {
+    "S3_BUCKET_NAME": "import-report",
+    "TASK_QUEUE_NAME": "import-report",
+    "WORKER_CONCURRENCY": "100",
+    "WORK_CURSOR_TABLE_NAME": "import-report",
+    "TASK_TABLE_NAME": "import-report",
+    "NOTIFICATION_QUEUE_NAME": "import-report.fifo",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+NUM_SLOWEST = 8
+
+
+def parse_importtime(stderr):
+    """
+    Parse `-X importtime` output into (module, self us, cumulative us, depth)
+    tuples.
+    """
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        records.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return records
+
+
+def measure_handler(handler):
+    """
+    Import a handler module in a fresh interpreter and return its import time
+    records (None if the import failed).
+    """
+    env = {**PLACEHOLDER_ENV, **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {handler}"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"{handler}: import failed\n{result.stderr.splitlines()[-1]}\n")
+        return None
+    return parse_importtime(result.stderr)
+
+
+def print_report(handler, records):
+    """
+    Print a handler's total import time and its slowest direct imports.
+
+    -X importtime lists a module after everything it imports, so the handler's
+    direct imports are the depth 1 records since the previous top-level import
+    (the interpreter's own startup imports come first and are left out).
+    """
+    handler_index = max(i for i, r in enumerate(records) if r[0] == handler and r[3] == 0)
+    first_index = max([i + 1 for i, r in enumerate(records[:handler_index]) if r[3] == 0], default=0)
+    direct_imports = [r for r in records[first_index:handler_index] if r[3] == 1]
+    print(f"{handler}: {records[handler_index][2] / 1000:.0f} ms")
+    for name, _, cumulative_us, _ in sorted(direct_imports, key=lambda r: -r[2])[:NUM_SLOWEST]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+    print()
+
+
+if __name__ == "__main__":
+    handlers = sys.argv[1:] or HANDLERS
+    for handler in handlers:
+        records = measure_handler(handler)
+        if records is not None:
+            print_report(handler, records)
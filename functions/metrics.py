@@ -0,0 +1,33 @@
+import json
+import time
+
+NAMESPACE = "ValidationServer"
+
+
+def emit_metric(name, value, unit="Count", dimensions=None, properties=None):
+    """
+    Publish a CloudWatch metric by logging it in the Embedded Metric Format
+    (no API call; CloudWatch extracts the metric from the Lambda's log stream).
+
+    Args:
+        name (str): metric name
+        value (float): metric value
+        unit (str): CloudWatch unit
+        dimensions (dict): low-cardinality dimensions to aggregate by
+        properties (dict): extra fields to log with the metric (e.g. job_id)
+    """
+    dimensions = dimensions or {}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit}],
+            }],
+        },
+        **dimensions,
+        **(properties or {}),
+        name: value,
+    }
+    print(json.dumps(record, default=str))
@@ -1,8 +1,33 @@
 import boto3
 import botocore 
 import datetime
+import json
 import logging
 import os 
+import time
+
+import config
+
+from metrics import (
+    emit_metric
+)
+from outbox import (
+    record_job_status,
+    sends_notifications,
+)
+from progress import (
+    compute_job_progress,
+    deregister_active_job,
+    find_stragglers,
+    get_task_records,
+    mark_task_speculated,
+)
+from tasks import (
+    compute_job_timeout_secs,
+    count_spawned_tasks,
+    get_job_in_flight_budget,
+    send_task,
+)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -16,6 +41,14 @@ s3 = boto3.client(
 s3_bucket = os.environ["S3_BUCKET_NAME"]
 
 
+class WorkerTaskFailedException(Exception): pass
+
+
+# Same name as rpy2's exception, so error.py reports it as an error in the 
+# user's script (this image doesn't have rpy2) 
+class RRuntimeError(Exception): pass
+
+
 def compute_num_completed_tasks(job_id): 
     """
     Compute number of files in the job's worker output S3 directory. 
@@ -33,10 +66,11 @@ def compute_num_completed_tasks(job_id):
 
 def compute_num_remaining_tasks(event): 
     """
-    Compute number of dispatched tasks that have not written output to S3.  
+    Compute number of dispatched tasks (including tasks split off by workers 
+    close to their deadline) that have not written output to S3.  
     """
     job_id = event["job_id"]
-    num_dispatched = event["num_tasks_dispatched"]
+    num_dispatched = event["num_tasks_dispatched"] + count_spawned_tasks(job_id)
     num_completed = compute_num_completed_tasks(job_id)
     num_remaining = num_dispatched - num_completed
     return num_remaining 
@@ -52,6 +86,68 @@ def compute_elapsed_secs(start_ftime):
     return elapsed_secs
 
 
+def report_job_progress(event, records): 
+    """
+    Publish the job's progress (fraction of rows processed, throughput and 
+    ETA) to the API and as CloudWatch metrics. 
+    """
+    progress = compute_job_progress(records, event.get("num_takeout_rows", 0))
+    logger.info(f"Job progress: {progress}")
+    result = {
+        "ok": True, 
+        "info": "running", 
+        "progress": progress
+    }
+    record_job_status(event, result)
+
+    properties = {"job_id": event["job_id"]}
+    for name, key, unit in [
+        ("JobFractionDone", "fraction_done", "None"), 
+        ("JobRowsPerSec", "rows_per_sec", "Count/Second"), 
+        ("JobEtaSecs", "eta_secs", "Seconds"), 
+    ]: 
+        if progress[key] is not None: 
+            emit_metric(name, progress[key], unit=unit, properties=properties)
+    return progress 
+
+
+def redispatch_stragglers(event, records, progress): 
+    """
+    Send a speculative copy of each static task that is running far longer than 
+    the job's median task. The copy has the same task ID, so whichever copy 
+    finishes first writes the task's output and the other one skips it. 
+    """
+    if progress["num_tasks_completed"] < config.STRAGGLER_MIN_COMPLETED_TASKS: 
+        return 0 
+    num_redispatched = 0 
+    for record in find_stragglers(records, progress["median_task_secs"]): 
+        if not mark_task_speculated(record): 
+            continue 
+        message = json.loads(record["message"])
+        send_task({**message, "speculative": True, "dispatched_at": time.time()})
+        logger.info(f"Re-dispatched straggler task {record['task_id']}")
+        num_redispatched += 1 
+    if num_redispatched: 
+        emit_metric("SpeculativeTasks", num_redispatched, properties={"job_id": event["job_id"]})
+    return num_redispatched 
+
+
+def raise_task_failure(records): 
+    """
+    Fail the job if any of its tasks failed, with an exception of the same type 
+    as the worker's when error.py distinguishes it. 
+    """
+    failed = [r for r in records if r["status"] == "failed"]
+    if not failed: 
+        return 
+    error_types = sorted({r["error_type"] for r in failed})
+    logger.error(f"{len(failed)} tasks failed ({', '.join(error_types)}), first: {failed[0]['task_id']}")
+    if "RRuntimeError" in error_types: 
+        raise RRuntimeError(f"{len(failed)} worker tasks failed")
+    raise WorkerTaskFailedException(f"{len(failed)} worker tasks failed ({', '.join(error_types)})")
+
+
+@sends_notifications
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
     num_remaining = compute_num_remaining_tasks(event)
@@ -64,18 +160,31 @@ def lambda_handler(event, context):
 
     # Job finished (all tasks completed)
     if num_remaining == 0: 
+        deregister_active_job(event["job_id"])
         return {
             **output, 
             "completed": True
         }
 
-    # Job timed out 
+    # Job failed (a worker task raised an exception) 
+    records = get_task_records(event["job_id"])
+    raise_task_failure(records)
+
+    # Job timed out (allowing for more waves if other jobs shrank its share 
+    # of the workers since it was dispatched) 
     class JobTimedOutException(Exception): pass
-    if elapsed_secs > event["job_timeout_secs"]:  
+    job_timeout_secs = max(event["job_timeout_secs"], compute_job_timeout_secs(
+        event["num_tasks_dispatched"], get_job_in_flight_budget(event["job_id"])
+    ))
+    if elapsed_secs > job_timeout_secs:  
         raise JobTimedOutException("Job timed out")
 
     # Job still running 
+    progress = report_job_progress(event, records)
+    redispatch_stragglers(event, records, progress)
     return {
         **output, 
+        "job_timeout_secs": job_timeout_secs, 
+        "progress": progress, 
         "completed": False
     }
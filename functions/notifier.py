@@ -0,0 +1,122 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import (
+    send_email_to_user,
+    update_job_status,
+    update_run_status,
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MAX_ATTEMPTS = 3        # Delivery attempts per notification within an invocation
+BACKOFF_SECS = 1        # Delay before the second attempt (doubles each retry)
+MAX_CONCURRENT_JOBS = 8 # Jobs whose notifications are delivered at the same time
+
+
+class NotificationDeliveryException(Exception): pass
+
+
+def deliver(notification):
+    """
+    Deliver a single notification (status update or email).
+    """
+    notification_type = notification["type"]
+    event = {
+        "job_id": notification["job_id"],
+        "run_id": notification.get("run_id"),
+        "user_email": notification.get("user_email"),
+    }
+    if notification_type == "email":
+        send_email_to_user(event, notification["subject"], notification["body"])
+        return
+    if notification_type == "job_status":
+        r = update_job_status(event, notification["result"])
+    elif notification_type == "run_status":
+        r = update_run_status(event, notification["result"])
+    else:
+        raise ValueError(f"Unknown notification type: {notification_type}")
+    if not r.ok:
+        raise NotificationDeliveryException(f"Status update returned {r.status_code}")
+
+
+def deliver_with_retries(notification):
+    """
+    Deliver a notification, retrying with exponential backoff. Returns True if
+    it was delivered.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            deliver(notification)
+            return True
+        except Exception as e:
+            logger.warning(f"Attempt {attempt + 1} to deliver {notification['type']} for job {notification['job_id']} failed: {e}")
+            if attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(BACKOFF_SECS * 2**attempt)
+    return False
+
+
+def get_status_target(notification):
+    """
+    Identify what a status notification updates (None for emails, which are
+    never coalesced).
+    """
+    if notification["type"] == "job_status":
+        return ("job", notification["job_id"])
+    if notification["type"] == "run_status":
+        return ("run", notification["job_id"], notification["run_id"])
+    return None
+
+
+def coalesce(records):
+    """
+    Drop status updates that a later update to the same job or run in the batch
+    supersedes. Returns the (message ID, notification) pairs to deliver, in order.
+    """
+    notifications = [(r["messageId"], json.loads(r["body"])) for r in records]
+    latest = {}
+    for i, (_, notification) in enumerate(notifications):
+        target = get_status_target(notification)
+        if target is not None:
+            latest[target] = i
+    return [
+        (message_id, notification)
+        for i, (message_id, notification) in enumerate(notifications)
+        if get_status_target(notification) is None or latest[get_status_target(notification)] == i
+    ]
+
+
+def deliver_group(records):
+    """
+    Deliver one job's notifications in order. Returns the message IDs that
+    must be retried: the first notification that couldn't be delivered and
+    everything after it, so the job's notifications stay in order.
+    """
+    records_to_deliver = coalesce(records)
+    for position, (message_id, notification) in enumerate(records_to_deliver):
+        if not deliver_with_retries(notification):
+            return [m for m, _ in records_to_deliver[position:]]
+    return []
+
+
+def lambda_handler(event, context):
+    """
+    Deliver a batch of notifications from the FIFO notification queue. Each
+    job's notifications (one message group) are delivered in order, and jobs
+    are delivered concurrently. Failed notifications are reported back to SQS
+    to be redelivered.
+    """
+    groups = {}
+    for record in event["Records"]:
+        groups.setdefault(record["attributes"]["MessageGroupId"], []).append(record)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS) as executor:
+        failed_message_ids = [m for failed in executor.map(deliver_group, groups.values()) for m in failed]
+
+    logger.info(f"Delivered {len(event['Records']) - len(failed_message_ids)} of {len(event['Records'])} notifications")
+    return {
+        "batchItemFailures": [{"itemIdentifier": m} for m in failed_message_ids]
+    }
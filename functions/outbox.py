@@ -0,0 +1,102 @@
+import boto3
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+
+from utils import (
+    SQS_BATCH_SIZE,
+    get_queue_url,
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+sqs = boto3.client("sqs")
+
+notification_queue_url = get_queue_url(os.environ["NOTIFICATION_QUEUE_NAME"])
+
+# Notifications recorded by this invocation and not yet sent to the queue
+# (module state outlives the invocation in a warm container, see sends_notifications())
+_notifications = []
+
+
+def record_notification(event, notification_type, **fields):
+    """
+    Record a notification to be delivered by the notifier after the handler
+    calls flush_notifications().
+    """
+    _notifications.append({
+        "type": notification_type,
+        "job_id": event["job_id"],
+        "recorded_at": time.time(),
+        **fields,
+    })
+
+
+def record_job_status(event, result):
+    """
+    Record a job status update for the API.
+    """
+    record_notification(event, "job_status", result=result)
+
+
+def record_run_status(event, result):
+    """
+    Record a run status update for the API.
+    """
+    record_notification(event, "run_status", run_id=event["run_id"], result=result)
+
+
+def record_email(event, subject, body):
+    """
+    Record an email to the user who submitted the job.
+    """
+    record_notification(event, "email", user_email=event["user_email"], subject=subject, body=body)
+
+
+def flush_notifications():
+    """
+    Send the recorded notifications to the FIFO notification queue in as few
+    requests as possible. Notifications for the same job share a message group,
+    so the notifier delivers them in the order they were recorded.
+    """
+    global _notifications
+    notifications, _notifications = _notifications, []
+    if not notifications:
+        return
+    for start in range(0, len(notifications), SQS_BATCH_SIZE):
+        batch = notifications[start:start + SQS_BATCH_SIZE]
+        response = sqs.send_message_batch(
+            QueueUrl=notification_queue_url,
+            Entries=[
+                {
+                    "Id": str(i),
+                    "MessageBody": json.dumps(n),
+                    "MessageGroupId": str(n["job_id"]),
+                    "MessageDeduplicationId": uuid.uuid4().hex,
+                }
+                for i, n in enumerate(batch)
+            ],
+        )
+        if response.get("Failed"):
+            raise RuntimeError(f"Failed to record notifications: {response['Failed']}")
+    logger.info(f"Recorded {len(notifications)} notifications")
+
+
+def sends_notifications(handler):
+    """
+    Decorate a Lambda handler that records notifications. Notifications left
+    over from an earlier invocation in the same container are dropped when the
+    handler starts, and the ones it records are sent even if it raises.
+    """
+    @functools.wraps(handler)
+    def wrapped_handler(event, context):
+        _notifications.clear()
+        try:
+            return handler(event, context)
+        finally:
+            flush_notifications()
+    return wrapped_handler
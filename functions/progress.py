@@ -0,0 +1,326 @@
+import boto3
+import botocore
+import json
+import os
+import statistics
+import time
+
+from boto3.dynamodb.conditions import Key
+
+import config
+
+# Task records expire a day after they were last written
+TASK_RECORD_TTL_SECS = 86400
+
+# Partition of the task table that lists the jobs sharing the workers
+ACTIVE_JOBS_PARTITION = "_active_jobs"
+
+_table = None
+
+
+def get_task_table():
+    """
+    Get the DynamoDB table of per-task progress records.
+    """
+    global _table
+    if _table is None:
+        _table = boto3.resource("dynamodb").Table(os.environ["TASK_TABLE_NAME"])
+    return _table
+
+
+def get_task_record_key(sqs_body):
+    """
+    Key of a task's record. Speculative copies of a straggler task are
+    recorded separately from the original so they don't overwrite it.
+    """
+    task_id = sqs_body["task_id"]
+    if sqs_body.get("speculative"):
+        task_id = f"{task_id}#speculative"
+    return {"job_id": str(sqs_body["job_id"]), "task_id": task_id}
+
+
+def record_task_started(sqs_body, rows_total=None, rows_done=0):
+    """
+    Record that a worker started a task. rows_total is the number of rows the
+    task will take out (None for dynamic tasks, which claim rows as they go)
+    and rows_done the number a redelivered task restored from its checkpoint.
+
+    The records of static tasks keep the task's message so the monitor can
+    re-dispatch it if it straggles. A redelivered task's record keeps when the
+    task first started and the rows it claimed (see record_task_claim()), and
+    the record of a task that already completed isn't changed.
+    """
+    now = int(time.time())
+    schedule = sqs_body.get("schedule", "static")
+    values = {
+        "status": "running",
+        "schedule": schedule,
+        "speculative": bool(sqs_body.get("speculative")),
+        "updated_at": now,
+        "rows_done": rows_done,
+        "expires_at": now + TASK_RECORD_TTL_SECS,
+    }
+    if rows_total is not None:
+        values["rows_total"] = rows_total
+    if schedule == "static" and not sqs_body.get("speculative"):
+        values["message"] = json.dumps(sqs_body)
+    try:
+        get_task_table().update_item(
+            Key=get_task_record_key(sqs_body),
+            UpdateExpression="SET started_at = if_not_exists(started_at, :now), "
+                             + ", ".join(f"#{name} = :{name}" for name in values),
+            ConditionExpression="attribute_not_exists(#status) OR #status <> :completed",
+            ExpressionAttributeNames={f"#{name}": name for name in values},
+            ExpressionAttributeValues={
+                ":now": now,
+                ":completed": "completed",
+                **{f":{name}": value for name, value in values.items()},
+            },
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+
+
+def record_task_claim(sqs_body, claim):
+    """
+    Append a [start, end] range of rows a dynamic task claimed from its
+    subset's cursor to the task's record, so a redelivery of the task can
+    re-claim the rows it hadn't taken out yet.
+    """
+    get_task_table().update_item(
+        Key=get_task_record_key(sqs_body),
+        UpdateExpression="SET claims = list_append(if_not_exists(claims, :empty), :claim)",
+        ExpressionAttributeValues={":empty": [], ":claim": [list(claim)]},
+    )
+
+
+def get_task_claims(sqs_body):
+    """
+    Get the ranges of rows a dynamic task claimed, in the order it claimed them.
+    """
+    response = get_task_table().get_item(Key=get_task_record_key(sqs_body), ConsistentRead=True)
+    return [(int(start), int(end)) for start, end in response.get("Item", {}).get("claims", [])]
+
+
+def record_task_progress(sqs_body, rows_done):
+    """
+    Record the number of rows a running task has taken out so far.
+    """
+    get_task_table().update_item(
+        Key=get_task_record_key(sqs_body),
+        UpdateExpression="SET rows_done = :rows_done, updated_at = :now",
+        ExpressionAttributeValues={":rows_done": rows_done, ":now": int(time.time())},
+    )
+
+
+def record_task_completed(sqs_body, rows_done):
+    """
+    Record that a task wrote its output after taking out rows_done rows.
+    """
+    now = int(time.time())
+    get_task_table().update_item(
+        Key=get_task_record_key(sqs_body),
+        UpdateExpression="SET #status = :status, rows_done = :rows_done, updated_at = :now, finished_at = :now",
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues={":status": "completed", ":rows_done": rows_done, ":now": now},
+    )
+
+
+def record_task_failed(sqs_body, error_type):
+    """
+    Record that a task raised an exception (only its type is kept; the
+    message could contain confidential data). The task may have failed
+    before it was recorded as started.
+    """
+    now = int(time.time())
+    get_task_table().update_item(
+        Key=get_task_record_key(sqs_body),
+        UpdateExpression="SET #status = :status, error_type = :error_type, updated_at = :now, "
+                         "started_at = if_not_exists(started_at, :now), rows_done = if_not_exists(rows_done, :zero), "
+                         "expires_at = if_not_exists(expires_at, :expires_at)",
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues={
+            ":status": "failed",
+            ":error_type": error_type,
+            ":now": now,
+            ":zero": 0,
+            ":expires_at": now + TASK_RECORD_TTL_SECS,
+        },
+    )
+
+
+def mark_task_speculated(record):
+    """
+    Mark a running task as having a speculative copy. Returns False if it
+    already has one or is no longer running, so each task is copied at most once.
+    """
+    try:
+        get_task_table().update_item(
+            Key={"job_id": record["job_id"], "task_id": record["task_id"]},
+            UpdateExpression="SET speculated_at = :now",
+            ConditionExpression="attribute_not_exists(speculated_at) AND #status = :running",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":now": int(time.time()), ":running": "running"},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+        return False
+    return True
+
+
+def mark_task_released(sqs_body):
+    """
+    Mark a task as having released its job's next pending task. Returns False
+    if it (or a copy of it) already did. Must be called after the task's
+    record was written.
+    """
+    try:
+        get_task_table().update_item(
+            Key={"job_id": str(sqs_body["job_id"]), "task_id": sqs_body["task_id"]},
+            UpdateExpression="SET released_at = :now",
+            ConditionExpression="attribute_not_exists(released_at)",
+            ExpressionAttributeValues={":now": int(time.time())},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise e
+        return False
+    return True
+
+
+def register_active_job(job_id, priority, demand):
+    """
+    Record that a job shares the workers until it finishes: its priority and
+    the most tasks it can have in flight at once (demand).
+    """
+    now = int(time.time())
+    get_task_table().put_item(Item={
+        "job_id": ACTIVE_JOBS_PARTITION,
+        "task_id": str(job_id),
+        "priority": priority,
+        "demand": demand,
+        "registered_at": now,
+        "expires_at": now + config.MAX_JOB_TIMEOUT_SECS,
+    })
+
+
+def deregister_active_job(job_id):
+    """
+    Stop counting a finished (or failed) job as sharing the workers.
+    """
+    get_task_table().delete_item(Key={"job_id": ACTIVE_JOBS_PARTITION, "task_id": str(job_id)})
+
+
+def get_active_jobs():
+    """
+    Get the (priority, demand) of each job sharing the workers, by job ID.
+    Records past their expiry that DynamoDB hasn't deleted yet are skipped.
+    """
+    now = int(time.time())
+    table = get_task_table()
+    kwargs = {"KeyConditionExpression": Key("job_id").eq(ACTIVE_JOBS_PARTITION), "ConsistentRead": True}
+    jobs = {}
+    while True:
+        response = table.query(**kwargs)
+        for item in response["Items"]:
+            if int(item["expires_at"]) > now:
+                jobs[item["task_id"]] = (item["priority"], int(item["demand"]))
+        if "LastEvaluatedKey" not in response:
+            return jobs
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def compute_in_flight_budgets(jobs, worker_concurrency):
+    """
+    Split worker_concurrency between jobs ({job_id: (priority, demand)}) in
+    proportion to their PRIORITY_WEIGHTS, returning each job's in-flight
+    budget. A job whose demand is below its share gets its demand and the rest
+    of its share goes to the other jobs (weighted max-min fairness), so a lone
+    job can use every worker. Every job gets at least one in-flight task.
+    """
+    budgets = {}
+    remaining = dict(jobs)
+    capacity = worker_concurrency
+    while remaining:
+        total_weight = sum(config.PRIORITY_WEIGHTS[priority] for priority, _ in remaining.values())
+        shares = {
+            job_id: capacity * config.PRIORITY_WEIGHTS[priority] / total_weight
+            for job_id, (priority, _) in remaining.items()
+        }
+        satisfied = [job_id for job_id, (_, demand) in remaining.items() if demand <= shares[job_id]]
+        if not satisfied:
+            for job_id in remaining:
+                budgets[job_id] = max(1, int(shares[job_id]))
+            break
+        for job_id in satisfied:
+            budgets[job_id] = remaining.pop(job_id)[1]
+            capacity -= budgets[job_id]
+    return budgets
+
+
+def get_task_records(job_id):
+    """
+    Get all of a job's task records.
+    """
+    table = get_task_table()
+    kwargs = {"KeyConditionExpression": Key("job_id").eq(str(job_id))}
+    records = []
+    while True:
+        response = table.query(**kwargs)
+        records += response["Items"]
+        if "LastEvaluatedKey" not in response:
+            return records
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def compute_job_progress(records, num_takeout_rows, now=None):
+    """
+    Summarize a job's task records: the fraction of its takeout rows processed,
+    its throughput (rows per second since its first task started), the median
+    duration of its completed tasks and the estimated seconds until it finishes
+    (None until there is a throughput to extrapolate from).
+    """
+    now = now or time.time()
+    records = [r for r in records if not r.get("speculative")]
+    rows_done = sum(int(r["rows_done"]) for r in records)
+    durations = [
+        int(r["finished_at"]) - int(r["started_at"])
+        for r in records if r["status"] == "completed"
+    ]
+    progress = {
+        "num_tasks_running": sum(1 for r in records if r["status"] == "running"),
+        "num_tasks_completed": len(durations),
+        "num_tasks_failed": sum(1 for r in records if r["status"] == "failed"),
+        "rows_done": rows_done,
+        "fraction_done": min(1.0, rows_done / num_takeout_rows) if num_takeout_rows else None,
+        "rows_per_sec": None,
+        "median_task_secs": statistics.median(durations) if durations else None,
+        "eta_secs": None,
+    }
+    if records and rows_done:
+        running_secs = max(1, now - min(int(r["started_at"]) for r in records))
+        progress["rows_per_sec"] = rows_done / running_secs
+        if num_takeout_rows:
+            progress["eta_secs"] = max(0, num_takeout_rows - rows_done) / progress["rows_per_sec"]
+    return progress
+
+
+def find_stragglers(records, median_task_secs, now=None):
+    """
+    Find the job's running static tasks that have run for more than
+    STRAGGLER_FACTOR times its median task duration and don't have a
+    speculative copy yet.
+    """
+    now = now or time.time()
+    threshold_secs = max(config.STRAGGLER_MIN_SECS, config.STRAGGLER_FACTOR * median_task_secs)
+    return [
+        r for r in records
+        if r["status"] == "running"
+        and r["schedule"] == "static"
+        and not r.get("speculative")
+        and "speculated_at" not in r
+        and "message" in r
+        and now - int(r["started_at"]) > threshold_secs
+    ]
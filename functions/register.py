@@ -0,0 +1,57 @@
+import logging
+
+import config
+
+from datasets import (
+    DATASET_REGISTRY,
+    build_dataset_schema,
+    get_dataset_metadata,
+    get_dataset_version,
+    is_dataset_schema_current,
+    write_dataset_schema,
+)
+from rsession import (
+    get_dataset_r_classes
+)
+from snapshots import (
+    register_dataset_snapshot
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def register_dataset_schema(dataset_id):
+    """
+    Build and store a dataset's schema if it is missing or was built from an
+    older version of the raw file. Returns whether it was (re)built.
+    """
+    version = get_dataset_version(dataset_id)
+    if is_dataset_schema_current(dataset_id, version):
+        return False
+    logger.info(f"Building schema for dataset {dataset_id} (version {version})")
+    r_classes = get_dataset_r_classes(get_dataset_metadata(dataset_id)["dataset_s3_uri"])
+    write_dataset_schema(dataset_id, build_dataset_schema(dataset_id, version, r_classes))
+    return True
+
+
+def register_dataset(dataset_id):
+    """
+    Precompute everything jobs need about the current version of a dataset, so 
+    no job pays for a full read of it. 
+    """
+    register_dataset_schema(dataset_id)
+    if config.USE_DATASET_SNAPSHOTS:
+        register_dataset_snapshot(dataset_id)
+
+
+def lambda_handler(event, context):
+    """
+    Register the datasets in the event (or every dataset in DATASET_REGISTRY). 
+    Invoked after a dataset is uploaded or updated, and daily to catch any 
+    dataset that wasn't; up to date datasets are skipped. 
+    """
+    logger.info(f"Input event: {event}")
+    for dataset_id in event.get("dataset_ids", list(DATASET_REGISTRY)):
+        register_dataset(dataset_id)
+    return event
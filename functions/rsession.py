@@ -0,0 +1,510 @@
+"""
+Embedded R session shared by the handlers that run R (validator, dispatcher, 
+validate_dispatch and worker). 
+
+Importing this module starts R, attaches the packages user scripts rely on and 
+defines the MOS R functions, so the work happens once per container during the 
+Lambda init phase rather than on every invocation. Handlers that don't run R 
+must not import it (directly or through another module). 
+"""
+from collections import OrderedDict
+import pandas as pd
+import rpy2.robjects as ro
+from rpy2 import rinterface as ri
+from rpy2.rinterface_lib import na_values
+from rpy2.robjects.conversion import localconverter, get_conversion
+
+import config
+
+_rpy2_conversion_rules = None
+
+# Pool subsets loaded into R (keyed by path and columns read), most recently used last 
+_subset_cache = OrderedDict()
+
+
+def get_rpy_conversion_rules(): 
+    """
+    Custom rpy2 conversion rules to better handle NAs from R to pandas dfs. 
+    Borrowed from here: https://stackoverflow.com/a/72670945 
+
+    The rules are built once per process. 
+    """
+    global _rpy2_conversion_rules
+    if _rpy2_conversion_rules is not None: 
+        return _rpy2_conversion_rules
+    df_rules = ro.default_converter
+
+    @df_rules.rpy2py.register(ri.IntSexpVector)
+    def to_int(obj):
+        return [int(v) if v != na_values.NA_Integer else pd.NA for v in obj]
+
+    @df_rules.rpy2py.register(ri.FloatSexpVector)
+    def to_float(obj):
+        return [float(v) if v != na_values.NA_Real else pd.NA for v in obj]
+
+    @df_rules.rpy2py.register(ri.StrSexpVector)
+    def to_str(obj):
+        return [str(v) if v != na_values.NA_Character else pd.NA for v in obj]
+
+    @df_rules.rpy2py.register(ri.BoolSexpVector)
+    def to_bool(obj):
+        return [bool(v) if v != na_values.NA_Logical else pd.NA for v in obj]
+
+    # Define the top-level converter
+    def toDataFrame(obj):
+        cv = get_conversion() # Get the converter from current context
+        return pd.DataFrame(
+            {str(k): cv.rpy2py(obj[i]) for i, k in enumerate(obj.names)}
+        )
+
+    # Associate the converter with R data.frame class
+    df_rules.rpy2py_nc_map[ri.ListSexpVector].update({"data.frame": toDataFrame})
+    _rpy2_conversion_rules = df_rules
+    return df_rules 
+
+
+def load_user_script(script_s3_uri): 
+    """
+    Use rpy2 to source an arbitrary R script from S3. 
+    """
+    ro.r["load_script_from_s3"](script_s3_uri)
+
+
+def to_r_col_classes(col_classes):
+    """
+    Convert a {column: R class} dictionary into a named R character vector for 
+    read.csv's colClasses argument (NA lets read.csv infer the classes). 
+    """
+    if col_classes is None: 
+        return ro.NA_Logical
+    r_col_classes = ro.StrVector(list(col_classes.values()))
+    r_col_classes.names = ro.StrVector(list(col_classes.keys()))
+    return r_col_classes
+
+
+def define_local_sensitivities_functions(): 
+    """
+    Define the R functions implementing the MOS local sensitivity algorithm. 
+
+    The algorithm is split into steps that keep their state in R so a worker can 
+    process several takeout ranges against one loaded subset: 
+    init_sensitivity_state() computes estimates on the full subset and assigns 
+    each statistic its integer key, 
+    get_takeout_order() lists the rows to take out, update_sensitivity_state() 
+    takes them out one at a time and updates the max sensitivities, and 
+    finalize_sensitivity_state() formats the output. 
+
+    In approximate mode, rows are taken out in descending order of a cheap 
+    influence proxy (leverage over the numeric columns plus the inverse size of 
+    each row's group in low-cardinality columns) and the update stops once 
+    `patience` consecutive rows fail to raise any statistic's max sensitivity. 
+
+    Statistics are lined up by position rather than merged on their label 
+    columns: each takeout's estimates are matched to the full subset's once (or 
+    not at all when they come back in the same order), and the state holds plain 
+    vectors indexed by statistic. 
+    """
+    ro.r(
+    """ 
+    make_statistic_index <- function(output, merge_cols) {
+        # One string per statistic from its label columns
+        do.call(paste, c(unname(as.list(output[merge_cols])), sep = "\r"))
+    }
+
+    init_sensitivity_state <- function(df, statistic_keys = NULL, output_full = NULL) {
+        # Compute estimates on full subset (unless its baseline was loaded)
+        if (is.null(output_full)) {
+            output_full <- run_analysis(df)
+        }
+        merge_cols <- names(output_full)[!(names(output_full) %in% c("value", "n"))]
+        statistic_index <- make_statistic_index(output_full, merge_cols)
+
+        # Key statistics by their row in the true output (or the full subset output)
+        if (is.null(statistic_keys)) {
+            stat_key <- seq_along(statistic_index) - 1L
+        } else {
+            stat_key <- match(statistic_index, make_statistic_index(statistic_keys, merge_cols)) - 1L
+        }
+        list(
+            df = df, merge_cols = merge_cols, statistic_cols = output_full[merge_cols], 
+            statistic_index = statistic_index, stat_key = stat_key, 
+            value_full = output_full$value, n_full = output_full$n, 
+            max_sensitivity = rep(0, nrow(output_full)), # Initialize at 0
+            rows_evaluated = 0L, stale_rows = 0L, converged = FALSE, 
+            cache = new.env() # Shared by copies of the state, e.g. the rows' influence
+        )
+    }
+
+    match_statistics <- function(state, output_takeout) {
+        # Row of output_takeout holding each full subset statistic (NA if missing)
+        statistic_cols <- state$statistic_cols
+        same_order <- nrow(output_takeout) == nrow(statistic_cols) && all(vapply(
+            state$merge_cols, 
+            function(col) identical(output_takeout[[col]], statistic_cols[[col]]), 
+            logical(1)
+        ))
+        if (same_order) {
+            return(seq_len(nrow(statistic_cols)))
+        }
+        match(state$statistic_index, make_statistic_index(output_takeout, state$merge_cols))
+    }
+
+    compute_influence <- function(df, max_group_levels = 50) {
+        influence <- numeric(nrow(df))
+
+        # Leverage (diagonal of the hat matrix) over the numeric columns
+        numeric_cols <- names(df)[vapply(df, is.numeric, logical(1))]
+        if (length(numeric_cols) > 0) {
+            x <- scale(as.matrix(df[numeric_cols]))
+            x[is.na(x)] <- 0 # Constant columns and missing values
+            x_qr <- qr(cbind(1, x))
+            q <- qr.Q(x_qr)[, seq_len(x_qr$rank), drop = FALSE]
+            influence <- influence + rowSums(q^2)
+        }
+
+        # Rows in small groups move table statistics the most 
+        for (col in names(df)) {
+            groups <- match(df[[col]], unique(df[[col]]))
+            if (!(col %in% numeric_cols) || max(groups) <= max_group_levels) {
+                influence <- influence + 1 / tabulate(groups)[groups]
+            }
+        }
+        influence
+    }
+
+    get_takeout_order <- function(state, takeout_start_index, takeout_end_index, approximate) {
+        takeout_indexes <- takeout_start_index:takeout_end_index
+        if (!approximate) {
+            return(takeout_indexes)
+        }
+        # Computed once per state, since dynamic tasks order every claimed chunk
+        if (is.null(state$cache$influence)) {
+            state$cache$influence <- compute_influence(state$df)
+        }
+        influence <- state$cache$influence[takeout_indexes]
+        takeout_indexes[order(influence, decreasing = TRUE)]
+    }
+
+    update_sensitivity_state <- function(state, takeout_indexes, patience = 0) {
+        df <- state$df
+        value_full <- state$value_full
+        max_sensitivity <- state$max_sensitivity
+        for (takeout_index in takeout_indexes) {
+            if (takeout_index %% 500 == 0) {
+                message(paste("Taking out row", takeout_index, 'out of', max(takeout_indexes)))
+            } 
+            # Re-compute estimates removing one observation at a time
+            df_takeout <- df[-takeout_index,]
+            output_takeout <- run_analysis(df_takeout)
+            
+            # Update max sensitivity for each statistic
+            value_takeout <- output_takeout$value[match_statistics(state, output_takeout)]
+            new_max_sensitivity <- pmax(abs(value_full - value_takeout), max_sensitivity)
+            increased <- any(new_max_sensitivity > max_sensitivity, na.rm = TRUE)
+            max_sensitivity <- new_max_sensitivity
+
+            # Stop early once the max sensitivities stop increasing
+            state$rows_evaluated <- state$rows_evaluated + 1L
+            state$stale_rows <- if (increased) 0L else state$stale_rows + 1L
+            if (patience > 0 && state$stale_rows >= patience) {
+                state$converged <- TRUE
+                break
+            }
+        }
+        state$max_sensitivity <- max_sensitivity
+        state
+    }
+
+    finalize_sensitivity_state <- function(state) {
+        # Format output columns (statistics missing from the true output are dropped)
+        output_full <- data.frame(stat_key = state$stat_key, n = state$n_full, ls = state$max_sensitivity)
+        return(output_full[!is.na(output_full$stat_key), , drop = FALSE])
+    }
+
+    save_sensitivity_checkpoint <- function(state, checkpoint_s3_uri, progress) {
+        checkpoint <- list(
+            max_sensitivity = state$max_sensitivity, rows_evaluated = state$rows_evaluated, 
+            stale_rows = state$stale_rows, converged = state$converged, progress = progress
+        )
+        aws.s3::s3saveRDS(
+            checkpoint, object = checkpoint_s3_uri, 
+            headers = list("x-amz-server-side-encryption" = "aws:kms")
+        )
+    }
+
+    restore_sensitivity_checkpoint <- function(state, checkpoint_s3_uri) {
+        if (!suppressMessages(aws.s3::object_exists(checkpoint_s3_uri))) {
+            return(list(state = state, progress = NULL))
+        }
+        checkpoint <- aws.s3::s3readRDS(object = checkpoint_s3_uri)
+        for (field in c("max_sensitivity", "rows_evaluated", "stale_rows", "converged")) {
+            state[[field]] <- checkpoint[[field]]
+        }
+        list(state = state, progress = checkpoint$progress)
+    }
+
+    load_subset <- function(data_s3_uri, col_classes) {
+        # Read subset from S3
+        aws.s3::s3read_using(read.csv, object = data_s3_uri, colClasses = col_classes)
+    }
+
+    read_fst_subset <- function(subset_path, columns) {
+        fst::read_fst(subset_path, columns = columns)
+    }
+
+    load_statistic_keys <- function(statistic_keys_s3_uri) {
+        aws.s3::s3readRDS(object = statistic_keys_s3_uri)
+    }
+
+    load_baseline <- function(df, baseline_s3_uri) {
+        # Estimates on the full subset, computed by the first task to need them
+        # (only if they don't exist yet; other errors, e.g. access denied, are raised)
+        output_full <- tryCatch(
+            aws.s3::s3readRDS(object = baseline_s3_uri), 
+            error = function(e) {
+                if (!grepl("NoSuchKey|Not Found|404", conditionMessage(e))) stop(e)
+                NULL
+            }
+        )
+        if (is.null(output_full)) {
+            output_full <- run_analysis(df)
+            aws.s3::s3saveRDS(
+                output_full, object = baseline_s3_uri, 
+                headers = list("x-amz-server-side-encryption" = "aws:kms")
+            )
+        }
+        output_full
+    }
+    """)
+
+
+def load_subset_r(subset_path, col_classes=None): 
+    """
+    Load a subset into R. csv subsets are read from S3. fst subsets (from the 
+    subset pool, already downloaded to a local path) contain every column of 
+    the dataset, so only the columns in col_classes are read (all of them if 
+    it is None), and keep their column classes. Since pool subsets never 
+    change, the last SUBSET_CACHE_MAX_FRAMES are kept in memory for later tasks. 
+    """
+    if not subset_path.endswith(".fst"): 
+        return ro.r["load_subset"](subset_path, to_r_col_classes(col_classes))
+
+    columns = list(col_classes) if col_classes else None 
+    cache_key = (subset_path, tuple(columns or ()))
+    if cache_key in _subset_cache: 
+        _subset_cache.move_to_end(cache_key)
+        return _subset_cache[cache_key]
+    df_r = ro.r["read_fst_subset"](subset_path, ro.StrVector(columns) if columns else ro.NULL)
+    _subset_cache[cache_key] = df_r
+    while len(_subset_cache) > config.SUBSET_CACHE_MAX_FRAMES: 
+        _subset_cache.popitem(last=False)
+    return df_r
+
+
+def save_baseline(script_s3_uri, subset_path, col_classes=None, baseline_s3_uri=None): 
+    """
+    Compute a subset's full subset estimates and save them to baseline_s3_uri 
+    for the subset's tasks (unless they were already saved). 
+    """
+    load_user_script(script_s3_uri)
+    df_r = load_subset_r(subset_path, col_classes)
+    ro.r["load_baseline"](df_r, baseline_s3_uri)
+
+
+def init_local_sensitivities_state(script_s3_uri, subset_path, col_classes=None, statistic_keys_s3_uri=None, baseline_s3_uri=None): 
+    """
+    Load the user script and subset into R and compute estimates on the full subset. 
+    Statistics are keyed by their row in the true output if statistic_keys_s3_uri 
+    is given (and by their row in the full subset output otherwise). 
+    If baseline_s3_uri is given, the full subset estimates are shared by all of 
+    the subset's tasks: loaded from there (the dispatcher saves them), or 
+    computed and saved there by the first task to need them. 
+    Returns the R state to pass to update_local_sensitivities_state(). 
+    """
+    load_user_script(script_s3_uri)
+    df_r = load_subset_r(subset_path, col_classes)
+    statistic_keys = ro.NULL
+    if statistic_keys_s3_uri is not None: 
+        statistic_keys = ro.r["load_statistic_keys"](statistic_keys_s3_uri)
+    output_full = ro.NULL
+    if baseline_s3_uri is not None: 
+        output_full = ro.r["load_baseline"](df_r, baseline_s3_uri)
+    return ro.r["init_sensitivity_state"](df_r, statistic_keys, output_full)
+
+
+def get_takeout_order(state, takeout_start_index, takeout_end_index, approximate=False): 
+    """
+    Get the rows takeout_start_index:takeout_end_index (R indexes) in the order 
+    they should be taken out (descending influence in approximate mode). 
+    """
+    takeout_indexes = ro.r["get_takeout_order"](state, takeout_start_index, takeout_end_index, approximate)
+    return [int(i) for i in takeout_indexes]
+
+
+def update_local_sensitivities_state(state, takeout_indexes, patience=0): 
+    """
+    Take out rows (list of R indexes) one at a time and update the max sensitivity 
+    of each statistic, stopping early after `patience` consecutive rows without an 
+    increase (0 to take out every row). 
+    """
+    return ro.r["update_sensitivity_state"](state, ro.IntVector(takeout_indexes), patience)
+
+
+def save_local_sensitivities_checkpoint(state, checkpoint_s3_uri, progress): 
+    """
+    Save the running max sensitivities and the task's progress (dictionary of 
+    integers, e.g. the number of takeouts completed) to S3. 
+    """
+    r_progress = ro.IntVector(list(progress.values()))
+    r_progress.names = ro.StrVector(list(progress.keys()))
+    ro.r["save_sensitivity_checkpoint"](state, checkpoint_s3_uri, r_progress)
+
+
+def restore_local_sensitivities_checkpoint(state, checkpoint_s3_uri): 
+    """
+    Restore the running max sensitivities from a checkpoint if one exists. 
+    Returns the (possibly restored) state and the saved progress (None if there 
+    was no checkpoint). 
+    """
+    restored = ro.r["restore_sensitivity_checkpoint"](state, checkpoint_s3_uri)
+    r_progress = restored.rx2("progress")
+    if ro.r["is.null"](r_progress)[0]: 
+        return state, None
+    progress = dict(zip(r_progress.names, [int(v) for v in r_progress]))
+    return restored.rx2("state"), progress
+
+
+def is_state_converged(state): 
+    """
+    Check whether an approximate run stopped early. 
+    """
+    return bool(state.rx2("converged")[0])
+
+
+def finalize_local_sensitivities_state(state): 
+    """
+    Convert the R state into a pandas df with local sensitivities for each statistic, 
+    along with the number of rows evaluated and why the run stopped. 
+    """
+    rpy2_conversion_rules = get_rpy_conversion_rules()
+    with localconverter(rpy2_conversion_rules): 
+        output_df_r = ro.r["finalize_sensitivity_state"](state)
+        output_df_pd = ro.conversion.rpy2py(output_df_r)
+    output_df_pd["rows_evaluated"] = int(state.rx2("rows_evaluated")[0])
+    output_df_pd["stop_reason"] = "converged" if is_state_converged(state) else "completed"
+    return output_df_pd 
+
+
+def get_local_sensitivities_df(script_s3_uri, subset_path, takeout_start_index, takeout_end_index, col_classes=None, approximate=False, patience=0, baseline_s3_uri=None):
+    """
+    Implement MOS algorithm to compute local sensitivities for subset (maximum difference 
+    between predicted value on full subset and predicted value from removing one observation) 
+    for each statistic.  
+
+    The algorithm is implemented as a function in R and called using rpy2 to minimize 
+    the conversion between R and Python. 
+
+    Args:
+        script_s3_uri (str): path to R script on S3 
+        subset_path (str): path to csv subset on S3 (or local path to a pool fst subset) 
+        takeout_start_index (int): first row index in subset to take out  
+        takeout_end_index (int): last row index in subset to take out  
+        col_classes (dict): optional R column classes for the subset columns 
+        approximate (bool): take out rows in descending influence order and stop early 
+        patience (int): consecutive rows without an increase before stopping early  
+        baseline_s3_uri (str): optional path on S3 to the subset's shared full subset estimates 
+
+    Returns:
+        pandas df with local sensitivities for each statistic (keyed by stat_key)   
+    """
+    state = init_local_sensitivities_state(script_s3_uri, subset_path, col_classes, baseline_s3_uri=baseline_s3_uri)
+    takeout_indexes = get_takeout_order(state, takeout_start_index, takeout_end_index, approximate)
+    state = update_local_sensitivities_state(state, takeout_indexes, patience if approximate else 0)
+    return finalize_local_sensitivities_state(state)
+
+
+def define_dataset_functions(): 
+    """
+    Define the R functions that read, sample and analyze full datasets 
+    (validation, registration, snapshots and the subset pool). 
+    """
+    ro.r(
+    """
+    get_dataset_r_classes <- function(dataset_s3_uri) {
+        df <- aws.s3::s3read_using(read.csv, object = dataset_s3_uri)
+        vapply(df, function(x) class(x)[1], character(1))
+    }
+
+    read_csv_dataset <- function(data_s3_uri, col_classes) {
+        aws.s3::s3read_using(read.csv, object = data_s3_uri, colClasses = col_classes)
+    }
+
+    build_fst_snapshot <- function(data_s3_uri, col_classes, snapshot_path) {
+        df <- read_csv_dataset(data_s3_uri, col_classes)
+        fst::write_fst(df, snapshot_path, compress = 50)
+    }
+
+    read_fst_snapshot <- function(snapshot_path, columns) {
+        fst::read_fst(snapshot_path, columns = columns)
+    }
+
+    sample_rows <- function(df, sample_frac) {
+        df[sample(nrow(df), round(nrow(df) * sample_frac)), , drop = FALSE]
+    }
+
+    split_sample_to_fst <- function(snapshot_path, sample_frac, k, out_dir) {
+        sampled_df <- sample_rows(fst::read_fst(snapshot_path), sample_frac)
+        rownames(sampled_df) <- NULL
+        subset_index <- cut(seq_len(nrow(sampled_df)), k, labels = FALSE) - 1L
+        paths <- character(k)
+        rows <- integer(k)
+        for (i in seq_len(k)) {
+            subset <- sampled_df[subset_index == i - 1L, , drop = FALSE]
+            rownames(subset) <- NULL
+            paths[i] <- file.path(out_dir, paste0(i - 1L, ".fst"))
+            fst::write_fst(subset, paths[i], compress = 50)
+            rows[i] <- nrow(subset)
+        }
+        list(paths = paths, rows = rows)
+    }
+
+    compute_output <- function(df, statistic_keys_s3_uri) {
+        output <- run_analysis(df)
+        statistic_keys <- output[, !(names(output) %in% c("value", "n")), drop = FALSE]
+        aws.s3::s3saveRDS(
+            statistic_keys, object = statistic_keys_s3_uri, 
+            headers = list("x-amz-server-side-encryption" = "aws:kms")
+        )
+        return(output)
+    }
+    """)
+
+
+def get_dataset_r_classes(dataset_s3_uri): 
+    """
+    Read a full dataset with read.csv's own type inference and return the R 
+    class of each column, so reads with explicit colClasses give R the same 
+    types as a plain read.csv. 
+    """
+    r_classes = ro.r["get_dataset_r_classes"](dataset_s3_uri)
+    return dict(zip(r_classes.names, r_classes))
+
+
+def init_r_session(): 
+    """
+    Attach the packages user scripts rely on and define the R functions used 
+    by every R handler. 
+    """
+    ro.r(
+    """
+    library(validationserver)
+    loadNamespace("aws.s3")
+    load_script_from_s3 <- function(script_s3_uri) {
+        aws.s3::s3source(script_s3_uri)
+    }
+    """)
+    define_local_sensitivities_functions()
+    define_dataset_functions()
+
+
+init_r_session()
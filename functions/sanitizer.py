@@ -9,11 +9,15 @@ import pandas as pd
 
 import config 
 
-from utils import (
-    send_email_to_user,
-    update_job_status,  
-    update_run_status, 
-    write_encrypted_csv_to_s3
+from storage import (
+    read_csv_from_s3,
+    write_encrypted_csv_to_s3,
+)
+from outbox import (
+    record_email,
+    record_job_status,  
+    record_run_status, 
+    sends_notifications,
 )
 
 s3 = boto3.client(
@@ -52,7 +56,7 @@ def get_unchanged_sanitized_values(event):
 
     # Get sanitized results from previous run 
     s3_path = f"s3://{s3_bucket}/submissions/{job_id}/sanitized_output_{previous_run_id}.csv"
-    df = pd.read_csv(s3_path)
+    df = read_csv_from_s3(s3_path)
 
     # Drop rows with user-updated epsilon values in the current run 
     new_ids = [e["statistic_id"] for e in event["epsilons"]]
@@ -87,7 +91,7 @@ def get_mos_values(job_id):
     Read csv with MOS values from S3 (created by combiner). 
     """
     s3_path = f"s3://{s3_bucket}/submissions/{job_id}/mos_output.csv"
-    df = pd.read_csv(s3_path)
+    df = read_csv_from_s3(s3_path)
     return df
 
 
@@ -129,7 +133,7 @@ def prep_output(event):
         prepped_df = add_default_epsilon_col(mos_df)
     else: # User-specified epsilon values
         epsilon_df = pd.DataFrame(event["epsilons"])
-        prepped_df = pd.merge(epsilon_df, mos_df, how="left", on="statistic_id")
+        prepped_df = epsilon_df.join(mos_df.set_index("statistic_id"), on="statistic_id")
     
     return prepped_df
 
@@ -151,9 +155,10 @@ def send_results_email(event):
     """
     subject = "Validation Server Results" 
     body = "Results are available."
-    send_email_to_user(event, subject, body)
+    record_email(event, subject, body)
 
 
+@sends_notifications
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")    
     prepped_df = prep_output(event)
@@ -163,7 +168,7 @@ def lambda_handler(event, context):
         "ok": True, 
         "info": "completed"    
     }   
-    update_job_status(event, result)
-    update_run_status(event, result)
+    record_job_status(event, result)
+    record_run_status(event, result)
     send_results_email(event)
     return event
@@ -0,0 +1,319 @@
+"""
+Static analysis of user-submitted R scripts to find the dataset columns they
+use, so jobs can read only those columns.
+
+The analysis errs towards reading every column: a script's statistics must be
+the same whether or not its columns were pruned. Besides scripts that build
+column names dynamically, that rules out scripts that use the data frame as a
+whole (na.omit(df), cor(df), sapply(df, ...), df[1:3], ...), since dropping
+columns changes which rows or values those see.
+"""
+import re
+
+# R functions that access columns without naming them (tidyselect helpers,
+# string-built names, positional indexing, etc.). If a script uses any of these,
+# the referenced columns can't be determined statically and every column is read.
+DYNAMIC_COLUMN_PATTERNS = [
+    r"\b(everything|starts_with|ends_with|contains|matches|num_range|all_of|any_of|where|across|last_col)\s*\(",
+    r"\b(names|colnames|setdiff|get|mget|assign|paste|paste0|sprintf|grep|grepl|sub|gsub|ncol|seq_along)\s*\(",
+    r"\bselect\s*\(\s*-",
+    r"\[\[(?!\s*(\"[^\"]*\"|'[^']*')\s*\]\])",
+    r"\[\s*,",
+    r"->",
+]
+
+# Functions that only touch the columns named in their other arguments when
+# passed the whole data frame, and whether they return a data frame (whose
+# uses must then be checked too)
+COLUMN_SAFE_FUNCTIONS = {
+    **{name: True for name in [
+        "filter", "mutate", "transmute", "select", "rename", "arrange", "group_by",
+        "ungroup", "rowwise", "summarise", "summarize", "count", "tally", "add_count",
+        "slice", "slice_head", "slice_tail", "slice_min", "slice_max", "slice_sample",
+        "sample_n", "sample_frac", "head", "tail", "within", "as_tibble", "as.data.frame",
+    ]},
+    **{name: False for name in [
+        "lm", "glm", "aov", "t.test", "xtabs", "nrow", "NROW", "with", "get_table_output",
+    ]},
+}
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<name>`[^`]*`|[A-Za-z.][A-Za-z0-9._]*|[0-9][A-Za-z0-9._]*)
+  | (?P<op>%[^%\n]*%|\|>|<<-|<-|:::|::|\[\[|\]\]|&&|\|\||==|!=|<=|>=|\n|[^\s])
+""", re.X)
+
+PIPES = {"%>%", "|>"}
+ASSIGNMENTS = {"<-", "<<-", "="}
+OPENERS = {"(": ")", "[": "]", "[[": "]]", "{": "}"}
+
+
+def is_name(token):
+    return token[0].isalpha() or token[0] in "._`"
+
+
+def is_string(token):
+    return token[0] in "\"'"
+
+
+def tokenize(script):
+    """
+    Split an R script into tokens (names, strings, operators and newlines),
+    dropping comments.
+    """
+    return [
+        m.group() for m in TOKEN_PATTERN.finditer(script)
+        if m.lastgroup != "comment"
+    ]
+
+
+class ScriptStructure:
+    """
+    Bracket structure of a tokenized script: the innermost opening bracket
+    enclosing each token, the matching bracket of each opening bracket and the
+    first token of each token's statement.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.enclosing = [None] * len(tokens)
+        self.matching = {}
+        self.statement_start = [0] * len(tokens)
+        stack = []
+        start = 0
+        for i, token in enumerate(tokens):
+            self.enclosing[i] = stack[-1] if stack else None
+            self.statement_start[i] = start
+            if token in OPENERS:
+                stack.append(i)
+                if token == "{":
+                    start = i + 1
+            elif token in (")", "]", "]]", "}") and stack:
+                # "]]" can also close two single brackets (x[y[1]])
+                opener = stack.pop()
+                if token == "]]" and tokens[opener] == "[" and stack:
+                    opener = stack.pop()
+                self.matching[opener] = i
+                # A closing bracket is enclosed by whatever encloses its opening bracket
+                self.enclosing[i] = self.enclosing[opener]
+            elif token == ";" or (token == "\n" and self.at_statement_level(i) and not self.continues(i)):
+                start = i + 1
+
+    def at_statement_level(self, i):
+        opener = self.enclosing[i]
+        return opener is None or self.tokens[opener] == "{"
+
+    def continues(self, i):
+        """
+        Check whether the expression before newline i continues on the next line.
+        """
+        previous = self.previous(i)
+        if previous is None:
+            return False
+        token = self.tokens[previous]
+        return token.startswith("%") or token in PIPES | ASSIGNMENTS | {
+            "+", "-", "*", "/", "^", "&", "|", "&&", "||", "==", "!=", "<", ">",
+            "<=", ">=", "~", "!", ",", "(", "[", "[[", "{", "$", "@", "::", ":::", ":", "?",
+        }
+
+    def statement_first(self, i):
+        """
+        First token of token i's statement.
+        """
+        return self.next(self.statement_start[i] - 1)
+
+    def previous(self, i):
+        i -= 1
+        while i >= 0 and self.tokens[i] == "\n":
+            i -= 1
+        return i if i >= 0 else None
+
+    def next(self, i, skip_newlines=True):
+        i += 1
+        while skip_newlines and i < len(self.tokens) and self.tokens[i] == "\n":
+            i += 1
+        return i if i < len(self.tokens) else None
+
+    def token(self, i):
+        return self.tokens[i] if i is not None else None
+
+    def call_start(self, opener):
+        """
+        First token of the function called with the parenthesis at `opener`
+        (None if it isn't a function call), e.g. dplyr for dplyr::filter(.
+        """
+        name = self.previous(opener)
+        if name is None or self.tokens[opener] != "(" or not is_name(self.tokens[name]):
+            return None
+        namespace_op = self.previous(name)
+        if self.token(namespace_op) in ("::", ":::"):
+            return self.previous(namespace_op)
+        return name
+
+    def call_name(self, opener):
+        name = self.previous(opener)
+        return self.tokens[name].strip("`")
+
+
+def get_data_frame_argument(structure):
+    """
+    Find the name of run_analysis()'s data frame argument (None if the script
+    doesn't define run_analysis).
+    """
+    tokens = structure.tokens
+    for i, token in enumerate(tokens[:-3]):
+        if token == "run_analysis" and tokens[i + 1] in ASSIGNMENTS and tokens[i + 2] == "function":
+            argument = structure.next(i + 3)
+            if tokens[i + 3] == "(" and argument is not None and is_name(tokens[argument]):
+                return tokens[argument]
+    return None
+
+
+def is_named_column_index(structure, opener):
+    """
+    Check whether a bracket index only selects columns by name (df["a"],
+    df[c("a", "b")], df[["a"]]), so the result only contains those columns.
+    """
+    contents = structure.tokens[opener + 1:structure.matching.get(opener, opener)]
+    contents = [t for t in contents if t != "\n"]
+    return any(is_string(t) for t in contents) and all(
+        is_string(t) or t in ("c", "(", ")", ",") for t in contents
+    )
+
+
+def check_data_frame_value(structure, start, end, derived_frames):
+    """
+    Check how the data frame valued expression tokens[start:end + 1] is used.
+    Returns False if it is used as a whole in a way that depends on which
+    columns it has. Names assigned a data frame derived from it are added to
+    derived_frames.
+    """
+    tokens = structure.tokens
+    following = structure.next(end, skip_newlines=not structure.at_statement_level(end))
+
+    # Pipe chain: every function it's piped through must be column-safe
+    if structure.token(following) in PIPES:
+        returns_frame = True
+        while structure.token(following) in PIPES:
+            name = structure.next(following)
+            opener = name
+            while structure.token(opener) in ("::", ":::") or (opener is not None and is_name(tokens[opener])):
+                opener = structure.next(opener, skip_newlines=False)
+            if structure.token(opener) != "(" or opener not in structure.matching:
+                return False
+            call_name = structure.call_name(opener)
+            if call_name not in COLUMN_SAFE_FUNCTIONS:
+                return False
+            returns_frame = COLUMN_SAFE_FUNCTIONS[call_name]
+            end = structure.matching[opener]
+            following = structure.next(end, skip_newlines=not structure.at_statement_level(end))
+        if not returns_frame:
+            return True
+        return check_data_frame_value(structure, start, end, derived_frames)
+
+    preceding = structure.previous(start)
+    opener = structure.enclosing[start]
+
+    # Whole argument of a function call
+    if opener is not None and tokens[opener] == "(":
+        if structure.token(following) not in (",", ")") or structure.token(preceding) not in ("(", ",", "="):
+            return False
+        call_start = structure.call_start(opener)
+        if call_start is None:
+            return False
+        call_name = structure.call_name(opener)
+        if call_name == "function":
+            return True
+        if call_name not in COLUMN_SAFE_FUNCTIONS:
+            return False
+        if not COLUMN_SAFE_FUNCTIONS[call_name]:
+            return True
+        return check_data_frame_value(structure, call_start, structure.matching[opener], derived_frames)
+
+    # Whole right-hand side of an assignment to a name
+    if structure.at_statement_level(start):
+        assigned = structure.statement_first(start)
+        statement_ends = following is None or tokens[following] in ("\n", ";", "}")
+        if (
+            statement_ends
+            and preceding == structure.next(assigned)
+            and tokens[preceding] in ASSIGNMENTS
+            and is_name(tokens[assigned])
+        ):
+            derived_frames.add(tokens[assigned])
+            return True
+    return False
+
+
+def check_data_frame_name(structure, i, derived_frames):
+    """
+    Check one occurrence of a data frame name (see check_data_frame_value()).
+    """
+    tokens = structure.tokens
+    preceding = structure.previous(i)
+    following = structure.next(i, skip_newlines=False)
+
+    # A column or argument name rather than the data frame
+    if structure.token(preceding) in ("$", "@", "::", ":::"):
+        return True
+    opener = structure.enclosing[i]
+    if structure.token(following) == "=" and opener is not None and tokens[opener] == "(":
+        return True
+
+    # Columns accessed by name
+    if structure.token(following) in ("$", "@"):
+        return True
+    if structure.token(following) in ("[", "[["):
+        return is_named_column_index(structure, following)
+
+    # Assigned to at the start of a statement
+    if structure.statement_first(i) == i and structure.token(following) in ASSIGNMENTS:
+        return True
+
+    return check_data_frame_value(structure, i, i, derived_frames)
+
+
+def uses_whole_data_frame(script):
+    """
+    Check whether a script uses run_analysis()'s data frame, or a data frame
+    derived from it, as a whole in a way that depends on which columns it has.
+    Scripts without a run_analysis(df) definition are treated as doing so.
+    """
+    structure = ScriptStructure(tokenize(script))
+    data_frame_argument = get_data_frame_argument(structure)
+    if data_frame_argument is None:
+        return True
+
+    frames = {data_frame_argument}
+    while True:
+        derived_frames = set()
+        for i, token in enumerate(structure.tokens):
+            if token in frames and not check_data_frame_name(structure, i, derived_frames):
+                return True
+        if derived_frames <= frames:
+            return False
+        frames |= derived_frames
+
+
+def find_script_columns(script, column_names):
+    """
+    Determine which of a dataset's columns an R script references.
+
+    Every identifier or string token in the script that matches a column name is
+    treated as a reference, which over- rather than under-selects. Returns None
+    (read every column) if the script accesses columns dynamically, uses the
+    data frame as a whole or references none of the columns by name.
+    """
+    if any(re.search(pattern, script) for pattern in DYNAMIC_COLUMN_PATTERNS):
+        return None
+    # A bare "." stands for every other column in a formula (y ~ x + .) and
+    # for the piped data frame in magrittr pipes
+    if "." in tokenize(script):
+        return None
+    if uses_whole_data_frame(script):
+        return None
+
+    tokens = set(re.findall(r"[A-Za-z0-9._]+", script))
+    columns = [c for c in column_names if c in tokens]
+    return columns or None
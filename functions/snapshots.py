@@ -0,0 +1,135 @@
+import boto3
+import botocore
+import glob
+import logging
+import os
+import rpy2.robjects as ro
+
+import config
+
+from datasets import (
+    get_dataset_metadata,
+    get_dataset_version,
+    get_r_col_classes,
+)
+from rsession import (
+    to_r_col_classes
+)
+
+s3 = boto3.client(
+    "s3",
+    region_name="us-east-1",
+    config=botocore.config.Config(s3={"addressing_style":"path"})
+)
+
+s3_bucket = os.environ["S3_BUCKET_NAME"]
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def get_snapshot_s3_key(dataset_id, version):
+    """
+    S3 key of a dataset version's fst snapshot.
+    """
+    return f"data/snapshots/{dataset_id}_{version}.fst"
+
+
+def get_snapshot_local_path(dataset_id, version):
+    """
+    Path of a dataset version's fst snapshot in the container cache.
+    """
+    return os.path.join(config.SNAPSHOT_DIR, f"{dataset_id}_{version}.fst")
+
+
+def build_snapshot(dataset_id, snapshot_path):
+    """
+    Convert a registered dataset's csv into an fst snapshot (all columns, with
+    the registered column classes).
+    """
+    metadata = get_dataset_metadata(dataset_id)
+    col_classes = get_r_col_classes(dataset_id)
+    ro.r["build_fst_snapshot"](metadata["dataset_s3_uri"], to_r_col_classes(col_classes), snapshot_path)
+
+
+def evict_old_snapshots(dataset_id, keep_path):
+    """
+    Remove cached snapshots of older versions of a dataset to bound /tmp usage.
+    """
+    for path in glob.glob(os.path.join(config.SNAPSHOT_DIR, f"{dataset_id}_*.fst")):
+        if path != keep_path:
+            os.remove(path)
+
+
+def snapshot_exists(dataset_id, version):
+    """
+    Check whether a dataset version's snapshot has been built.
+    """
+    try:
+        s3.head_object(Bucket=s3_bucket, Key=get_snapshot_s3_key(dataset_id, version))
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise e
+        return False
+    return True
+
+
+def register_dataset_snapshot(dataset_id):
+    """
+    Build the current version of a dataset's fst snapshot from the csv and
+    upload it for every container, unless it already exists. Returns whether
+    it was built.
+    """
+    version = get_dataset_version(dataset_id)
+    if snapshot_exists(dataset_id, version):
+        return False
+    logger.info(f"Building snapshot for dataset {dataset_id} (version {version})")
+    os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+    local_path = get_snapshot_local_path(dataset_id, version)
+    build_snapshot(dataset_id, local_path)
+    s3.upload_file(local_path, s3_bucket, get_snapshot_s3_key(dataset_id, version), ExtraArgs={"ServerSideEncryption": "aws:kms"})
+    os.remove(local_path)
+    return True
+
+
+def get_snapshot_path(dataset_id):
+    """
+    Get the local path of a dataset's fst snapshot, or None if the current
+    version of the dataset hasn't been registered yet (see register.py).
+    Snapshots are cached in the container and downloaded from S3 on a cold start.
+    """
+    version = get_dataset_version(dataset_id)
+    local_path = get_snapshot_local_path(dataset_id, version)
+    if os.path.exists(local_path):
+        return local_path
+
+    os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+    evict_old_snapshots(dataset_id, local_path)
+    tmp_path = f"{local_path}.part"
+    try:
+        s3.download_file(s3_bucket, get_snapshot_s3_key(dataset_id, version), tmp_path)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise e
+        logger.warning(f"Dataset {dataset_id} (version {version}) has no snapshot")
+        return None
+
+    # Rename once complete so an interrupted download is never treated as cached
+    os.replace(tmp_path, local_path)
+    return local_path
+
+
+def load_dataset_r(dataset_id, columns=None):
+    """
+    Load a registered dataset into R (optionally only some of its columns) and
+    return the R data.frame. Reads the fst snapshot when snapshots are enabled
+    and falls back to parsing the csv otherwise (or until the snapshot is built).
+    """
+    snapshot_path = get_snapshot_path(dataset_id) if config.USE_DATASET_SNAPSHOTS else None
+    if snapshot_path is not None:
+        r_columns = ro.NULL if columns is None else ro.StrVector(columns)
+        return ro.r["read_fst_snapshot"](snapshot_path, r_columns)
+
+    metadata = get_dataset_metadata(dataset_id)
+    col_classes = get_r_col_classes(dataset_id, columns)
+    return ro.r["read_csv_dataset"](metadata["dataset_s3_uri"], to_r_col_classes(col_classes))
@@ -0,0 +1,141 @@
+import gzip
+import io
+import pandas as pd
+import s3fs
+
+import config
+
+# File extension added to S3 paths for each compression
+COMPRESSION_EXTENSIONS = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+_fs = None
+
+
+def get_s3_filesystem():
+    """
+    Get the s3fs filesystem for this process, configured to specify KMS SSE on
+    every write. Reusing it keeps its S3 client and connection pool warm across
+    calls (and across invocations of a warm Lambda).
+    """
+    global _fs
+    if _fs is None:
+        _fs = s3fs.S3FileSystem(
+            default_block_size=config.S3_WRITE_BLOCK_BYTES,
+            s3_additional_kwargs={
+                "ServerSideEncryption": "aws:kms"
+            }
+        )
+    return _fs
+
+
+def add_compression_extension(s3_path, compression):
+    """
+    Add the file extension for a compression to an S3 path.
+    """
+    return s3_path + COMPRESSION_EXTENSIONS[compression]
+
+
+def infer_compression(s3_path):
+    """
+    Infer the compression of an S3 object from its file extension.
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if extension and s3_path.endswith(extension):
+            return compression
+    return None
+
+
+def get_zstandard():
+    """
+    Import zstandard, which is only needed for zstd compressed objects.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+def open_compressed_writer(f, compression):
+    """
+    Wrap a binary file handle so that bytes written to it are compressed.
+    Closing the wrapper doesn't close f.
+    """
+    if compression is None:
+        return NonClosingWriter(f)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=config.GZIP_LEVEL)
+    if compression == "zstd":
+        zstandard = get_zstandard()
+        return zstandard.ZstdCompressor(level=config.ZSTD_LEVEL).stream_writer(f, closefd=False)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def open_compressed_reader(f, compression):
+    """
+    Wrap a binary file handle so that bytes read from it are decompressed.
+    """
+    if compression is None:
+        return f
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if compression == "zstd":
+        zstandard = get_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+class NonClosingWriter(io.RawIOBase):
+    """
+    Pass writes through to a file handle without closing it, so that the
+    uncompressed case closes the same way as the compressed ones.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.f.write(b)
+
+
+def write_encrypted_csv_to_s3(df, s3_path, index=False, compression=None):
+    """
+    Write a pandas df as a csv to an encrypted S3 bucket (KMS SSE).
+
+    The csv is serialized CSV_CHUNK_ROWS rows at a time and streamed through the
+    (optional) compressor into a multipart upload, so at most one chunk of text
+    and one S3_WRITE_BLOCK_BYTES part are held in memory at once.
+
+    Args:
+        df (pd.DataFrame): data to write
+        s3_path (str): destination S3 URI, including any compression extension
+        index (bool): whether to write the df index
+        compression (str): None, "gzip" or "zstd"
+    """
+    fs = get_s3_filesystem()
+    with fs.open(s3_path, "wb") as f:
+        with open_compressed_writer(f, compression) as compressed:
+            with io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+                # Always write at least one chunk so empty dfs still get a header
+                for start in range(0, max(len(df), 1), config.CSV_CHUNK_ROWS):
+                    chunk = df.iloc[start:start + config.CSV_CHUNK_ROWS]
+                    chunk.to_csv(text, index=index, header=(start == 0))
+
+
+def read_csv_from_s3(s3_path, **kwargs):
+    """
+    Read a csv from S3 into a pandas df, decompressing it according to its
+    file extension. Extra arguments are passed to pd.read_csv.
+    """
+    fs = get_s3_filesystem()
+    with fs.open(s3_path, "rb") as f:
+        with open_compressed_reader(f, infer_compression(s3_path)) as decompressed:
+            df = pd.read_csv(decompressed, **kwargs)
+    return df
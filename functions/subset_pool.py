@@ -0,0 +1,223 @@
+import boto3
+import botocore
+import glob
+import json
+import logging
+import os
+import random
+import time
+import uuid
+import rpy2.robjects as ro
+
+import config
+
+from claims import (
+    get_cursor_backend
+)
+from datasets import (
+    get_dataset_version
+)
+from snapshots import (
+    get_snapshot_path
+)
+
+s3 = boto3.client(
+    "s3",
+    region_name="us-east-1",
+    config=botocore.config.Config(s3={"addressing_style":"path"})
+)
+
+s3_bucket = os.environ["S3_BUCKET_NAME"]
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def get_manifest_s3_key(dataset_id):
+    """
+    S3 key of the manifest listing a dataset's pooled subset sets.
+    """
+    return f"pools/{dataset_id}/manifest.json"
+
+
+def get_pool_subset_s3_key(dataset_id, set_id, subset_index):
+    """
+    S3 key of one subset of a pooled subset set.
+    """
+    return f"pools/{dataset_id}/{set_id}/{subset_index}.fst"
+
+
+def is_pool_subset(subset_s3_uri):
+    """
+    Check whether a task's subset comes from the subset pool.
+    """
+    return subset_s3_uri.startswith(f"s3://{s3_bucket}/pools/")
+
+
+def read_manifest(dataset_id):
+    """
+    Read a dataset's pool manifest (an empty pool if there isn't one yet).
+    """
+    try:
+        obj = s3.get_object(Bucket=s3_bucket, Key=get_manifest_s3_key(dataset_id))
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise e
+        return {"dataset_id": dataset_id, "sets": []}
+    return json.loads(obj["Body"].read())
+
+
+def write_manifest(manifest):
+    """
+    Write a dataset's pool manifest.
+    """
+    s3.put_object(
+        Bucket=s3_bucket,
+        Key=get_manifest_s3_key(manifest["dataset_id"]),
+        Body=json.dumps(manifest),
+        ServerSideEncryption="aws:kms",
+    )
+
+
+def get_usable_sets(manifest, dataset_id):
+    """
+    Get the pooled sets that were sampled from the current version of the
+    dataset with the current sampling parameters, and that are recent enough
+    that the bucket's lifecycle rule won't delete their subsets during a job.
+    """
+    version = get_dataset_version(dataset_id)
+    min_created_at = time.time() - config.POOL_SET_MAX_AGE_SECS
+    return [
+        s for s in manifest["sets"]
+        if s["dataset_version"] == version and s["sample_frac"] == config.SAMPLE_FRAC and s["k"] == config.K
+        and s["created_at"] >= min_created_at
+    ]
+
+
+def claim_pool_set_use(dataset_id, pool_set):
+    """
+    Count a job's use of a pooled set. Returns False if the set has already
+    served POOL_SET_MAX_USES jobs.
+    """
+    if config.POOL_SET_MAX_USES is None:
+        return True
+    uses = get_cursor_backend().increment(
+        f"pool_{dataset_id}_{pool_set['set_id']}", ttl_secs=config.POOL_SET_MAX_AGE_SECS
+    )
+    return uses <= config.POOL_SET_MAX_USES
+
+
+def choose_pool_set(dataset_id, policy):
+    """
+    Choose a pooled subset set for a job, or None if the pool is off or has
+    no usable sets (the job then samples its own subsets).
+
+    "rotate" cycles through the sets with a shared counter so consecutive jobs
+    get different samples, "random" picks one at random. Every job on a set
+    reuses the same sample (and so the same noise calibration), so sets that
+    have served POOL_SET_MAX_USES jobs are skipped.
+    """
+    if policy == "off":
+        return None
+    sets = get_usable_sets(read_manifest(dataset_id), dataset_id)
+    if policy == "rotate" and sets:
+        start = get_cursor_backend().increment(f"pool_{dataset_id}") % len(sets)
+        sets = sets[start:] + sets[:start]
+    else:
+        sets = random.sample(sets, len(sets))
+    for pool_set in sets:
+        if claim_pool_set_use(dataset_id, pool_set):
+            return pool_set
+    logger.info(f"No usable pooled subsets for dataset {dataset_id}")
+    return None
+
+
+def build_pool_set(dataset_id, snapshot_path):
+    """
+    Sample the dataset, split the sample into K subsets and upload each as an
+    fst file. Returns the set's manifest entry.
+    """
+    set_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    out_dir = os.path.join(config.SUBSET_CACHE_DIR, "build", set_id)
+    os.makedirs(out_dir, exist_ok=True)
+    split = ro.r["split_sample_to_fst"](snapshot_path, config.SAMPLE_FRAC, config.K, out_dir)
+
+    subset_s3_uris = []
+    for subset_index, path in enumerate(split.rx2("paths")):
+        s3_key = get_pool_subset_s3_key(dataset_id, set_id, subset_index)
+        s3.upload_file(path, s3_bucket, s3_key, ExtraArgs={"ServerSideEncryption": "aws:kms"})
+        os.remove(path)
+        subset_s3_uris.append(f"s3://{s3_bucket}/{s3_key}")
+    os.rmdir(out_dir)
+
+    return {
+        "set_id": set_id,
+        "dataset_version": get_dataset_version(dataset_id),
+        "sample_frac": config.SAMPLE_FRAC,
+        "k": config.K,
+        "subset_s3_uris": subset_s3_uris,
+        "subset_rows": [int(n) for n in split.rx2("rows")],
+        "created_at": time.time(),
+    }
+
+
+def refresh_pool(dataset_id):
+    """
+    Add POOL_SETS_PER_REFRESH new sets to a dataset's pool and drop the oldest
+    so it keeps POOL_SIZE sets. Dropped sets are left for the bucket's
+    lifecycle rule so jobs still using them aren't affected.
+    """
+    snapshot_path = get_snapshot_path(dataset_id)
+    if snapshot_path is None:
+        logger.info(f"Skipping pool refresh for dataset {dataset_id} until it is registered")
+        return
+    new_sets = [build_pool_set(dataset_id, snapshot_path) for _ in range(config.POOL_SETS_PER_REFRESH)]
+    manifest = read_manifest(dataset_id)
+    manifest["sets"] = (new_sets + manifest["sets"])[:config.POOL_SIZE]
+    write_manifest(manifest)
+    logger.info(f"Pool for dataset {dataset_id} has {len(manifest['sets'])} sets")
+
+
+def get_local_subset_path(subset_s3_uri):
+    """
+    Get the local path of a pool subset, downloading it into the container's
+    subset cache if needed. Keeps at most SUBSET_CACHE_MAX_FILES subsets,
+    evicting the least recently used.
+    """
+    relative_path = subset_s3_uri[len(f"s3://{s3_bucket}/pools/"):]
+    local_path = os.path.join(config.SUBSET_CACHE_DIR, relative_path.replace("/", "_"))
+    if os.path.exists(local_path):
+        os.utime(local_path)
+        return local_path
+
+    os.makedirs(config.SUBSET_CACHE_DIR, exist_ok=True)
+    cached_paths = sorted(glob.glob(os.path.join(config.SUBSET_CACHE_DIR, "*.fst")), key=os.path.getmtime)
+    for path in cached_paths[:max(0, len(cached_paths) - config.SUBSET_CACHE_MAX_FILES + 1)]:
+        os.remove(path)
+
+    # Rename once complete so an interrupted download is never treated as cached
+    tmp_path = f"{local_path}.part"
+    s3.download_file(s3_bucket, f"pools/{relative_path}", tmp_path)
+    os.replace(tmp_path, local_path)
+    return local_path
+
+
+def get_subset_path(subset_s3_uri):
+    """
+    Get the path a worker should load a subset from: the local copy of a pool
+    subset, or the S3 path of a job's own csv subset.
+    """
+    if is_pool_subset(subset_s3_uri):
+        return get_local_subset_path(subset_s3_uri)
+    return subset_s3_uri
+
+
+def lambda_handler(event, context):
+    """
+    Scheduled refresh of the subset pools (for the datasets in the event, or
+    POOL_DATASETS).
+    """
+    logger.info(f"Input event: {event}")
+    for dataset_id in event.get("dataset_ids", config.POOL_DATASETS):
+        refresh_pool(dataset_id)
+    return event
@@ -0,0 +1,322 @@
+import boto3
+import botocore
+import json
+import logging
+import math
+import os
+import re
+import time
+
+import config
+
+from claims import (
+    get_cursor_backend
+)
+from progress import (
+    compute_in_flight_budgets,
+    get_active_jobs,
+    mark_task_released,
+    register_active_job,
+)
+from utils import (
+    SQS_BATCH_SIZE,
+    get_queue_url,
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.client(
+    "s3",
+    region_name="us-east-1",
+    config=botocore.config.Config(s3={"addressing_style":"path"})
+)
+sqs = boto3.client("sqs")
+
+s3_bucket = os.environ["S3_BUCKET_NAME"]
+
+# Pending tasks are stored in pages so releasing one doesn't read the whole backlog
+PENDING_PAGE_SIZE = 100
+
+# All jobs share one queue, whose Lambda event source runs at most
+# WORKER_CONCURRENCY workers. Jobs are prioritized by how many tasks each may
+# have in flight (see get_job_in_flight_budget()), so the queue never holds more
+# than about one wave of tasks ahead of a new job's.
+task_queue_url = get_queue_url(os.environ["TASK_QUEUE_NAME"])
+
+
+def generate_task_id(dataset_id, subset_index, takeout_start_index, takeout_end_index):
+    """
+    Create unique task ID for a worker.
+    """
+    id = f"{dataset_id}_{subset_index}_{takeout_start_index}_{takeout_end_index}"
+    return id
+
+
+def get_job_priority(event, num_tasks):
+    """
+    Get a job's priority: set on the event, or based on the job's size so small
+    jobs aren't stuck behind large ones.
+    """
+    if event.get("priority") in config.PRIORITY_WEIGHTS:
+        return event["priority"]
+    if num_tasks <= config.HIGH_PRIORITY_MAX_TASKS:
+        return "high"
+    if num_tasks >= config.LOW_PRIORITY_MIN_TASKS:
+        return "low"
+    return "normal"
+
+
+def send_task(message):
+    """
+    Send a worker task message to SQS.
+    """
+    response = sqs.send_message(QueueUrl=task_queue_url, MessageBody=json.dumps(message))
+    return response
+
+
+def send_tasks(messages):
+    """
+    Send worker task messages to SQS in batches.
+    """
+    for start in range(0, len(messages), SQS_BATCH_SIZE):
+        batch = messages[start:start + SQS_BATCH_SIZE]
+        response = sqs.send_message_batch(
+            QueueUrl=task_queue_url,
+            Entries=[{"Id": str(i), "MessageBody": json.dumps(m)} for i, m in enumerate(batch)],
+        )
+        if response.get("Failed"):
+            raise RuntimeError(f"Failed to send tasks: {response['Failed']}")
+
+
+def get_in_flight_counter_id(job_id):
+    """
+    Create the ID of the counter of a job's in-flight (queued or running) tasks.
+    """
+    return f"{job_id}_in_flight"
+
+
+def get_job_in_flight_budget(job_id):
+    """
+    Get the number of tasks a job may have in flight right now: its share of
+    the workers, weighted by priority, among the jobs currently sharing them.
+    Budgets change as jobs start and finish; a job over its budget releases no
+    pending tasks until enough of its tasks finished.
+    """
+    budgets = compute_in_flight_budgets(get_active_jobs(), int(os.environ["WORKER_CONCURRENCY"]))
+    return budgets.get(str(job_id), 1)
+
+
+def compute_job_timeout_secs(num_tasks, in_flight_budget):
+    """
+    Compute a job's timeout: JOB_TIMEOUT_SECS, extended by MAX_SECS_PER_TASK
+    for each wave of in_flight_budget tasks after the first, up to
+    MAX_JOB_TIMEOUT_SECS (so the monitor, rather than the state machine's own
+    timeout, times the job out and the error handler reports it).
+    """
+    job_timeout_secs = int(os.environ["JOB_TIMEOUT_SECS"])
+    num_waves = math.ceil(num_tasks / in_flight_budget)
+    if num_waves > 1:
+        job_timeout_secs += (num_waves - 1) * config.MAX_SECS_PER_TASK
+    return min(job_timeout_secs, config.MAX_JOB_TIMEOUT_SECS)
+
+
+def get_pending_cursor_id(job_id):
+    """
+    Create the ID of the work cursor over a job's pending tasks.
+    """
+    return f"{job_id}_pending"
+
+
+def get_pending_page_s3_key(job_id, page_index):
+    """
+    S3 key of a page of a job's pending tasks.
+    """
+    return f"pending/{job_id}/{page_index}.json"
+
+
+def write_pending_tasks(job_id, messages):
+    """
+    Store tasks that are held back until the job has room for more in-flight
+    tasks, and reset the cursor workers release them with.
+    """
+    for start in range(0, len(messages), PENDING_PAGE_SIZE):
+        s3.put_object(
+            Bucket=s3_bucket,
+            Key=get_pending_page_s3_key(job_id, start // PENDING_PAGE_SIZE),
+            Body=json.dumps(messages[start:start + PENDING_PAGE_SIZE]),
+            ServerSideEncryption="aws:kms",
+        )
+    get_cursor_backend().reset(get_pending_cursor_id(job_id), len(messages))
+
+
+def submit_tasks(event, messages):
+    """
+    Assign a job's tasks a priority, register the job as sharing the workers
+    and send as many tasks as its in-flight budget allows. The rest are stored
+    and released as workers finish, so one large job can't fill the queue ahead
+    of everything submitted after it. The job is deregistered once it finishes
+    or fails (see monitor.py and error.py).
+
+    Returns the total number of tasks.
+    """
+    job_id = event["job_id"]
+    priority = get_job_priority(event, len(messages))
+    demand = min(len(messages), config.MAX_IN_FLIGHT_TASKS_PER_JOB or len(messages))
+    register_active_job(job_id, priority, demand)
+    num_in_flight = min(len(messages), get_job_in_flight_budget(job_id))
+    has_pending_tasks = len(messages) > num_in_flight
+    dispatched_at = time.time()
+    messages = [
+        {**m, "priority": priority, "dispatched_at": dispatched_at, "has_pending_tasks": has_pending_tasks}
+        for m in messages
+    ]
+
+    if has_pending_tasks:
+        write_pending_tasks(job_id, messages[num_in_flight:])
+        backend = get_cursor_backend()
+        backend.reset(get_in_flight_counter_id(job_id), None)
+        backend.increment(get_in_flight_counter_id(job_id), n=num_in_flight)
+    send_tasks(messages[:num_in_flight])
+    logger.info(f"Submitted {len(messages)} {priority} priority tasks ({num_in_flight} in flight)")
+    return len(messages)
+
+
+def claim_pending_task(job_id):
+    """
+    Take the job's next pending task off its pending cursor, or None if it has
+    no pending tasks left.
+    """
+    claim = get_cursor_backend().claim(get_pending_cursor_id(job_id), 1)
+    if claim is None:
+        return None
+    pending_index = claim[0] - 1
+    page_index, page_position = divmod(pending_index, PENDING_PAGE_SIZE)
+    obj = s3.get_object(Bucket=s3_bucket, Key=get_pending_page_s3_key(job_id, page_index))
+    return json.loads(obj["Body"].read())[page_position]
+
+
+def release_pending_task(sqs_body):
+    """
+    Free a finished task's in-flight slot and send the job's pending tasks
+    until it is back at its in-flight budget (none if the job is over its
+    budget, several if its budget grew since). Called by a worker once its
+    task's output is written (by it or another copy of the task). Each task
+    frees its slot once, however many copies of it finish.
+
+    A task that split work off hands its in-flight slot to the task it split
+    off (which keeps the message's has_pending_tasks), so only the last task
+    of a chain of split-off tasks releases.
+    """
+    if not sqs_body.get("has_pending_tasks"):
+        return
+    if has_spawned_tasks(sqs_body["job_id"], sqs_body["task_id"]):
+        return
+    if not mark_task_released(sqs_body):
+        return
+    job_id = sqs_body["job_id"]
+    backend = get_cursor_backend()
+    counter_id = get_in_flight_counter_id(job_id)
+    num_in_flight = backend.increment(counter_id, n=-1)
+    budget = get_job_in_flight_budget(job_id)
+    # Take a slot before claiming a pending task, so workers finishing at the
+    # same time can't overshoot the budget together
+    while num_in_flight < budget:
+        num_in_flight = backend.increment(counter_id)
+        message = None
+        if num_in_flight <= budget:
+            message = claim_pending_task(job_id)
+        if message is None:
+            backend.increment(counter_id, n=-1)
+            return
+        send_task(message)
+
+
+def get_spawned_task_s3_key(job_id, task_id):
+    """
+    S3 key of the record of a task split off by a worker.
+    """
+    return f"spawned/{job_id}/{task_id}"
+
+
+def get_spawned_task_id(task_id, kind, spawned_messages):
+    """
+    Create the ID of the next task split off from a task ("s" for a static
+    task's remaining rows, "c" for a dynamic task's continuation). IDs only
+    depend on the parent task and the tasks already split off from it, so a
+    redelivered parent never splits the same rows off under a different ID.
+    """
+    return f"{task_id}_{kind}{len(spawned_messages)}"
+
+
+def record_spawned_task(message, sent=False):
+    """
+    Record a task created by a worker (rather than the dispatcher) so the monitor
+    waits for its output too. Must be called before the task is sent, and again
+    once it has been sent.
+    """
+    s3.put_object(
+        Bucket=s3_bucket,
+        Key=get_spawned_task_s3_key(message["job_id"], message["task_id"]),
+        Body=json.dumps({"message": message, "sent": sent}),
+        ServerSideEncryption="aws:kms",
+    )
+
+
+def spawn_task(message):
+    """
+    Record and send a task split off by a worker.
+    """
+    message = {**message, "dispatched_at": time.time()}
+    record_spawned_task(message)
+    response = send_task(message)
+    record_spawned_task(message, sent=True)
+    return response
+
+
+def get_spawned_tasks(job_id, task_id):
+    """
+    Get the messages of the tasks split off from a task, in the order they were
+    split off. A redelivered task uses them to skip the rows it already split
+    off. Tasks that were recorded but not sent (the worker died in between)
+    are sent now.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=s3_bucket, Prefix=get_spawned_task_s3_key(job_id, f"{task_id}_"))
+    spawned = {}
+    for page in pages:
+        for obj in page.get("Contents", []):
+            match = re.fullmatch(rf".*/{re.escape(task_id)}_[sc](\d+)", obj["Key"])
+            if match is None:
+                continue
+            record = json.loads(s3.get_object(Bucket=s3_bucket, Key=obj["Key"])["Body"].read())
+            if not record["sent"]:
+                send_task(record["message"])
+                record_spawned_task(record["message"], sent=True)
+            spawned[int(match.group(1))] = record["message"]
+    return [spawned[i] for i in sorted(spawned)]
+
+
+def has_spawned_tasks(job_id, task_id):
+    """
+    Check whether any task was split off from a task.
+    """
+    response = s3.list_objects_v2(
+        Bucket=s3_bucket, Prefix=get_spawned_task_s3_key(job_id, f"{task_id}_"), MaxKeys=1
+    )
+    return response["KeyCount"] > 0
+
+
+def count_spawned_tasks(job_id):
+    """
+    Count the tasks workers have split off for a job.
+
+    Note: need to use paginator to get around 1000 item limit
+    https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListObjectsV2.html
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=s3_bucket, Prefix=f"spawned/{job_id}/")
+    num_spawned = 0
+    for page in pages:
+        num_spawned += page["KeyCount"]
+    return num_spawned
@@ -0,0 +1,106 @@
+import logging
+import rpy2.robjects as ro
+from rpy2.robjects.conversion import localconverter
+
+import config
+
+from cache import (
+    get_cache_keys,
+    restore_cached_output,
+    store_cached_output,
+)
+from datasets import (
+    get_analysis_columns,
+    get_r_col_classes,
+)
+from dispatcher import (
+    compute_workers_per_k,
+    dispatch_subsets,
+    update_state_machine,
+    write_subsets_to_s3,
+)
+from snapshots import (
+    load_dataset_r
+)
+from rsession import (
+    get_rpy_conversion_rules
+)
+from outbox import (
+    flush_notifications,
+    record_job_status,
+    sends_notifications,
+)
+from utils import (
+    get_statistic_keys_s3_uri
+)
+from validator import (
+    get_output_df,
+    send_success_job_submission_email,
+    write_true_output_to_s3,
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def sample_rows(df_r, sample_frac):
+    """
+    Sample the full dataset already loaded into R and return the sample as a
+    pandas df.
+    """
+    sampled_df_r = ro.r["sample_rows"](df_r, sample_frac)
+    rpy2_conversion_rules = get_rpy_conversion_rules()
+    with localconverter(rpy2_conversion_rules):
+        return ro.conversion.rpy2py(sampled_df_r)
+
+
+@sends_notifications
+def lambda_handler(event, context):
+    """
+    Combined Validate+Dispatch step: read the full dataset once, compute the true
+    values on it, then sample, calibrate and dispatch from the same in-memory
+    data and warm R session (calibration still times a subset read from S3,
+    as in the separate Dispatch step).
+    """
+    logger.info(f"Input event: {event}")
+    script_s3_uri = event["script_path"]
+    dataset_id = event["dataset_id"]
+    event = {**event, "cache_keys": get_cache_keys(event)}
+    true_output_cached = restore_cached_output(event, "true_output")
+    mos_cached = restore_cached_output(event, "mos_output")
+
+    # Validate
+    if not (true_output_cached and mos_cached):
+        columns = get_analysis_columns(script_s3_uri, dataset_id)
+        df_r = load_dataset_r(dataset_id, columns)
+    if not true_output_cached:
+        true_output_df = get_output_df(script_s3_uri, df_r, get_statistic_keys_s3_uri(event["job_id"]))
+        write_true_output_to_s3(true_output_df, event)
+        store_cached_output(event, "true_output")
+    result = {
+        "ok": True,
+        "info": "running"
+    }
+    record_job_status(event, result)
+    send_success_job_submission_email(event)
+    # Sent now rather than when the handler returns, so the user hears the job 
+    # is running before the (longer) dispatch
+    flush_notifications()
+
+    # MOS inputs were restored from the cache, so there is nothing to dispatch
+    if mos_cached:
+        payload = update_state_machine(event, 0)
+        return {
+            **payload,
+            "mos_cached": True
+        }
+
+    # Dispatch
+    sampled_df = sample_rows(df_r, config.SAMPLE_FRAC)
+    del df_r
+    subsets = write_subsets_to_s3(sampled_df, event["job_id"], dataset_id)
+    col_classes = get_r_col_classes(dataset_id, columns, drop_unused=False)
+    workers_per_k = compute_workers_per_k(event, subsets, context, col_classes)
+    num_tasks, num_takeout_rows = dispatch_subsets(event, subsets, workers_per_k, columns)
+    payload = update_state_machine(event, num_tasks, num_takeout_rows)
+    return payload
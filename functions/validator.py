@@ -6,13 +6,33 @@ import pandas as pd
 import rpy2.robjects as ro
 from rpy2.robjects.conversion import localconverter
 
-from utils import (
+from cache import (
+    get_cache_keys,
+    restore_cached_output,
+    store_cached_output,
+)
+from datasets import (
+    get_analysis_columns,
     get_dataset_metadata,
+    get_read_csv_kwargs,
+)
+from snapshots import (
+    load_dataset_r
+)
+from storage import (
+    write_encrypted_csv_to_s3
+)
+from rsession import (
     get_rpy_conversion_rules, 
     load_user_script, 
-    send_email_to_user, 
-    update_job_status,
-    write_encrypted_csv_to_s3, 
+)
+from outbox import (
+    record_email, 
+    record_job_status, 
+    sends_notifications,
+)
+from utils import (
+    get_statistic_keys_s3_uri
 )
 
 s3 = boto3.client(
@@ -27,33 +47,30 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def load_confidential_data(event): 
+def load_confidential_data(event, columns=None): 
     """
     Read confidential data from S3. 
     """
-    metadata = get_dataset_metadata(event["dataset_id"])
+    dataset_id = event["dataset_id"]
+    metadata = get_dataset_metadata(dataset_id)
     dataset_s3_uri = metadata["dataset_s3_uri"]
-    df = pd.read_csv(dataset_s3_uri)
+    df = pd.read_csv(dataset_s3_uri, **get_read_csv_kwargs(dataset_id, columns))
     return df 
 
 
-def get_output_df(script_s3_uri, df_s3_uri):  
-    """
-    Use rpy2 to read a csv from S3, run the analysis (R script must contain the 
-    run_analysis() function) and return the output as a pandas df. 
+def get_output_df(script_s3_uri, df_r, statistic_keys_s3_uri):  
     """
-    ro.r(
+    Use rpy2 to run the analysis (R script must contain the run_analysis() 
+    function) on a data.frame already loaded into R and return the output as 
+    a pandas df. 
+
+    The output's label columns are also saved to S3 so workers can key each 
+    statistic by its row in the true output. 
     """
-    compute_output <- function(data_s3_uri) {
-        df <- aws.s3::s3read_using(read.csv, object = data_s3_uri)
-        output <- run_analysis(df)
-        return(output)
-    }
-    """)
     load_user_script(script_s3_uri)
     rpy2_conversion_rules = get_rpy_conversion_rules()
     with localconverter(rpy2_conversion_rules): 
-        output_df_r = ro.r["compute_output"](df_s3_uri)
+        output_df_r = ro.r["compute_output"](df_r, statistic_keys_s3_uri)
         output_df_pd = ro.conversion.rpy2py(output_df_r)
     return output_df_pd
 
@@ -63,9 +80,10 @@ def compute_true_values(event):
     Run R script against the full dataset.  
     """
     script_s3_uri = event["script_path"]
-    metadata = get_dataset_metadata(event["dataset_id"])
-    dataset_s3_uri = metadata["dataset_s3_uri"]
-    output_df = get_output_df(script_s3_uri, dataset_s3_uri)
+    dataset_id = event["dataset_id"]
+    columns = get_analysis_columns(script_s3_uri, dataset_id)
+    df_r = load_dataset_r(dataset_id, columns)
+    output_df = get_output_df(script_s3_uri, df_r, get_statistic_keys_s3_uri(event["job_id"]))
     return output_df
 
 
@@ -85,17 +103,21 @@ def send_success_job_submission_email(event):
     """
     subject = "Validation Server Job Status" 
     body = "Job was successfully submitted."
-    send_email_to_user(event, subject, body)
+    record_email(event, subject, body)
 
 
+@sends_notifications
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
-    true_output_df = compute_true_values(event) 
-    write_true_output_to_s3(true_output_df, event) 
+    event = {**event, "cache_keys": get_cache_keys(event)}
+    if not restore_cached_output(event, "true_output"): 
+        true_output_df = compute_true_values(event) 
+        write_true_output_to_s3(true_output_df, event) 
+        store_cached_output(event, "true_output")
     result = {
         "ok": True, 
         "info": "running"
     }   
-    update_job_status(event, result)
+    record_job_status(event, result)
     send_success_job_submission_email(event)
     return event
@@ -4,11 +4,53 @@ import json
 import logging
 import os 
 import sys
+import time
 import traceback
 
+import config 
+
+from claims import (
+    find_orphaned_claims,
+    get_cursor_backend,
+)
+from datasets import (
+    get_r_col_classes
+)
+from metrics import (
+    emit_metric
+)
+from progress import (
+    get_task_claims,
+    record_task_claim,
+    record_task_completed,
+    record_task_failed,
+    record_task_progress,
+    record_task_started,
+)
+from storage import (
+    add_compression_extension,
+    write_encrypted_csv_to_s3,
+)
+from subset_pool import (
+    get_subset_path
+)
+from tasks import (
+    get_spawned_task_id,
+    get_spawned_tasks,
+    release_pending_task,
+    spawn_task,
+)
+from rsession import (
+    finalize_local_sensitivities_state,
+    get_takeout_order,
+    init_local_sensitivities_state,
+    is_state_converged,
+    restore_local_sensitivities_checkpoint,
+    save_local_sensitivities_checkpoint,
+    update_local_sensitivities_state,
+)
 from utils import (
-    get_local_sensitivities_df, 
-    write_encrypted_csv_to_s3
+    get_statistic_keys_s3_uri
 )
 
 s3 = boto3.client(
@@ -23,29 +65,302 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def get_worker_output_s3_key(sqs_body): 
+    """
+    S3 key of a task's output (shared by speculative copies of the task). 
+    """
+    job_id = sqs_body["job_id"]
+    task_id = sqs_body["task_id"]
+    return add_compression_extension(f"intermediate/{job_id}/{task_id}.csv", config.INTERMEDIATE_COMPRESSION)
+
+
 def write_worker_output_to_s3(output_df, sqs_body):
     """ 
     Write csv output result to S3. 
     """
+    s3_path = f"s3://{s3_bucket}/{get_worker_output_s3_key(sqs_body)}"
+    write_encrypted_csv_to_s3(output_df, s3_path, compression=config.INTERMEDIATE_COMPRESSION)
+
+
+def is_output_written(sqs_body): 
+    """
+    Check whether another copy of the task (the original or a speculative copy 
+    of a straggler) already wrote its output. 
+    """
+    try: 
+        s3.head_object(Bucket=s3_bucket, Key=get_worker_output_s3_key(sqs_body))
+    except botocore.exceptions.ClientError as e: 
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"): 
+            raise e 
+        return False 
+    return True 
+
+
+def report_queue_wait(sqs_body): 
+    """
+    Emit how long the task waited between being dispatched and starting 
+    (including any time it was held back by the job's in-flight limit). 
+    """
+    if "dispatched_at" not in sqs_body: 
+        return 
+    emit_metric(
+        "QueueWaitSecs", 
+        time.time() - sqs_body["dispatched_at"], 
+        unit="Seconds", 
+        dimensions={"Priority": sqs_body.get("priority", "normal")}, 
+        properties={"job_id": sqs_body["job_id"], "task_id": sqs_body["task_id"]}, 
+    )
+
+
+def report_progress(sqs_body, rows_done, last_report_time): 
+    """
+    Record the task's progress if PROGRESS_INTERVAL_SECS have passed since it 
+    was last recorded. Returns when progress was last recorded. 
+    """
+    if time.time() - last_report_time < config.PROGRESS_INTERVAL_SECS: 
+        return last_report_time 
+    record_task_progress(sqs_body, rows_done)
+    return time.time()
+
+
+def is_approximate(sqs_body): 
+    """
+    Check whether a task uses the approximate local sensitivity mode. 
+    """
+    return sqs_body.get("sensitivity_mode") == "approximate"
+
+
+def get_checkpoint_s3_key(sqs_body, message_id): 
+    """
+    S3 key of a task's checkpoint. The SQS message ID is kept when a message is 
+    redelivered, so only retries of the same message resume from it. 
+    """
     job_id = sqs_body["job_id"]
     task_id = sqs_body["task_id"]
-    s3_path = f"s3://{s3_bucket}/intermediate/{job_id}/{task_id}.csv"
-    write_encrypted_csv_to_s3(output_df, s3_path)
+    return f"checkpoints/{job_id}/{task_id}_{message_id}.rds"
+
+
+def delete_checkpoint(checkpoint_s3_key): 
+    """
+    Delete a task's checkpoint once its output has been written. 
+    """
+    s3.delete_object(Bucket=s3_bucket, Key=checkpoint_s3_key)
+
+
+def is_deadline_near(context, chunk_secs): 
+    """
+    Check whether the Lambda is too close to its timeout to process another 
+    chunk of rows and still write its output. 
+    """
+    remaining_secs = context.get_remaining_time_in_millis() / 1000 
+    return remaining_secs < config.DEADLINE_BUFFER_SECS + 2 * chunk_secs
+
+
+def spawn_remaining_takeouts(sqs_body, remaining_takeout_indexes, spawned_messages): 
+    """
+    Send the rows a task didn't get to as a new task. 
+    """
+    task_id = get_spawned_task_id(sqs_body["task_id"], "s", spawned_messages)
+    message = {
+        **sqs_body, 
+        "task_id": task_id,
+        "takeout_start_index": min(remaining_takeout_indexes),
+        "takeout_end_index": max(remaining_takeout_indexes),
+        "takeout_indexes": remaining_takeout_indexes, 
+    }
+    spawn_task(message)
+    logger.info(f"Split off {len(remaining_takeout_indexes)} rows as task {task_id}")
+
+
+def get_static_local_sensitivities_df(sqs_body, checkpoint_s3_uri, context, col_classes=None): 
+    """
+    Compute local sensitivities for the task's takeout range, checkpointing the 
+    running max sensitivities and the number of completed takeouts every 
+    CHECKPOINT_INTERVAL_SECS. A redelivered task resumes from its checkpoint. 
+
+    If the Lambda gets close to its timeout, the rows not yet taken out are sent 
+    as a new task and the output covers only the rows processed so far. A 
+    redelivered task skips the rows it already split off. A speculative copy of 
+    a straggler doesn't split; it gives up and returns None, leaving the rows to 
+    the original task. 
+    """
+    approximate = is_approximate(sqs_body)
+    patience = sqs_body["patience"] if approximate else 0 
+
+    state = init_local_sensitivities_state(
+        sqs_body["script_s3_uri"], get_subset_path(sqs_body["subset_s3_uri"]), col_classes, 
+        get_statistic_keys_s3_uri(sqs_body["job_id"]), sqs_body.get("baseline_s3_uri")
+    )
+    takeout_indexes = sqs_body.get("takeout_indexes") or get_takeout_order(
+        state, sqs_body["takeout_start_index"], sqs_body["takeout_end_index"], approximate
+    )
+    spawned_messages = get_spawned_tasks(sqs_body["job_id"], sqs_body["task_id"])
+    split_indexes = {i for m in spawned_messages for i in m["takeout_indexes"]}
+    takeout_indexes = [i for i in takeout_indexes if i not in split_indexes]
+    state, progress = restore_local_sensitivities_checkpoint(state, checkpoint_s3_uri)
+    position = 0 
+    if progress is not None: 
+        position = progress["position"]
+        logger.info(f"Resuming after row {progress['last_takeout_index']} ({position} of {len(takeout_indexes)} rows done)")
+    record_task_started(sqs_body, len(takeout_indexes), position)
+
+    last_checkpoint_time = time.time()
+    last_report_time = time.time()
+    chunk_secs = 0 
+    while position < len(takeout_indexes) and not is_state_converged(state): 
+        if is_deadline_near(context, chunk_secs): 
+            if sqs_body.get("speculative"): 
+                logger.info(f"Speculative copy of task {sqs_body['task_id']} ran out of time")
+                return None 
+            spawn_remaining_takeouts(sqs_body, takeout_indexes[position:], spawned_messages)
+            break 
+        chunk = takeout_indexes[position:position + config.TAKEOUT_CHUNK_ROWS]
+        chunk_start_time = time.time()
+        state = update_local_sensitivities_state(state, chunk, patience)
+        chunk_secs = time.time() - chunk_start_time
+        position += len(chunk)
+        last_report_time = report_progress(sqs_body, position, last_report_time)
+        if time.time() - last_checkpoint_time >= config.CHECKPOINT_INTERVAL_SECS: 
+            save_local_sensitivities_checkpoint(
+                state, checkpoint_s3_uri, {"position": position, "last_takeout_index": chunk[-1]}
+            )
+            last_checkpoint_time = time.time()
+
+    output_df = finalize_local_sensitivities_state(state)
+    logger.info(f"Evaluated {output_df['rows_evaluated'].iloc[0]} rows ({output_df['stop_reason'].iloc[0]})")
+    return output_df 
+
+
+def claim_next_chunk(sqs_body, backend, orphaned_claims): 
+    """
+    Claim the next chunk of rows for a dynamic task: the first of the rows it 
+    claimed before it was redelivered, or else a new chunk from the subset's 
+    cursor (recorded in the task table). Returns None once the subset is exhausted. 
+    """
+    if orphaned_claims: 
+        return orphaned_claims.pop(0)
+    claim = backend.claim(sqs_body["cursor_id"], sqs_body["claim_rows"])
+    if claim is not None: 
+        record_task_claim(sqs_body, claim)
+    return claim 
+
+
+def get_dynamic_local_sensitivities_df(sqs_body, checkpoint_s3_uri, context, col_classes=None): 
+    """
+    Claim chunks of rows from the subset's shared cursor until it is exhausted 
+    and compute one partial max sensitivity over all of the claimed rows. 
+
+    In approximate mode, rows within each claimed chunk are taken out in 
+    descending influence order and the worker stops claiming once its max 
+    sensitivities stop increasing. The cursor hands out rows in subset order, 
+    so unlike static tasks the influence order only applies within each chunk 
+    of CLAIM_CHUNK_ROWS rows, not across the subset. 
+
+    Each claim is recorded in the task table, and the number of claims taken out 
+    is checkpointed with the max sensitivities so far every 
+    CHECKPOINT_INTERVAL_SECS, so a redelivered task re-claims the rows it 
+    claimed after its last checkpoint instead of losing them. 
+
+    If the Lambda gets close to its timeout, the worker stops claiming and, if 
+    the subset isn't exhausted yet, sends a continuation task that keeps claiming 
+    (and takes over any re-claimed rows the worker didn't get to). 
+    """
+    backend = get_cursor_backend()
+    cursor_id = sqs_body["cursor_id"]
+    approximate = is_approximate(sqs_body)
+    patience = sqs_body["patience"] if approximate else 0 
+
+    state = init_local_sensitivities_state(
+        sqs_body["script_s3_uri"], get_subset_path(sqs_body["subset_s3_uri"]), col_classes, 
+        get_statistic_keys_s3_uri(sqs_body["job_id"]), sqs_body.get("baseline_s3_uri")
+    )
+    state, progress = restore_local_sensitivities_checkpoint(state, checkpoint_s3_uri)
+    claims_done = num_rows = 0 
+    if progress is not None: 
+        claims_done = progress["claims_done"]
+        num_rows = progress["rows_done"]
+        logger.info(f"Resuming after {claims_done} claims ({num_rows} rows done)")
+    # Claims handed over by the task's parent come first, then the task's own 
+    # (less any a redelivered task already handed over to a continuation) 
+    claims = [tuple(c) for c in sqs_body.get("orphaned_claims", [])] + get_task_claims(sqs_body)
+    spawned_messages = get_spawned_tasks(sqs_body["job_id"], sqs_body["task_id"])
+    orphaned_claims = find_orphaned_claims(claims, claims_done, spawned_messages)
+    if orphaned_claims: 
+        logger.info(f"Re-claiming {len(orphaned_claims)} chunks claimed before the task was redelivered")
+    record_task_started(sqs_body, rows_done=num_rows)
+
+    chunk_secs = 0 
+    last_checkpoint_time = time.time()
+    last_report_time = time.time()
+    claim = claim_next_chunk(sqs_body, backend, orphaned_claims)
+    while claim is not None and not is_state_converged(state): 
+        takeout_start_index, takeout_end_index = claim
+        takeout_indexes = get_takeout_order(state, takeout_start_index, takeout_end_index, approximate)
+        chunk_start_time = time.time()
+        state = update_local_sensitivities_state(state, takeout_indexes, patience)
+        chunk_secs = time.time() - chunk_start_time
+        num_rows += takeout_end_index - takeout_start_index + 1
+        claims_done += 1 
+        last_report_time = report_progress(sqs_body, num_rows, last_report_time)
+        if time.time() - last_checkpoint_time >= config.CHECKPOINT_INTERVAL_SECS: 
+            save_local_sensitivities_checkpoint(
+                state, checkpoint_s3_uri, {"claims_done": claims_done, "rows_done": num_rows}
+            )
+            last_checkpoint_time = time.time()
+        if is_state_converged(state): 
+            break 
+        if is_deadline_near(context, chunk_secs): 
+            if orphaned_claims or not backend.is_exhausted(cursor_id): 
+                task_id = get_spawned_task_id(sqs_body["task_id"], "c", spawned_messages)
+                spawn_task({**sqs_body, "task_id": task_id, "orphaned_claims": orphaned_claims})
+                logger.info(f"Split off a continuation of task {sqs_body['task_id']}")
+            break 
+        claim = claim_next_chunk(sqs_body, backend, orphaned_claims)
+
+    logger.info(f"Took out {num_rows} rows claimed from cursor {cursor_id}")
+    return finalize_local_sensitivities_state(state)
 
 
 def lambda_handler(event, context):
     logger.info(f"Input event: {event}")
+    sqs_body = None 
     try:
         # Parse SQS task
         sqs_body = json.loads(event["Records"][0]["body"])
-        subset_s3_uri = sqs_body["subset_s3_uri"]
-        script_s3_uri = sqs_body["script_s3_uri"]
-        takeout_start_index = sqs_body["takeout_start_index"]
-        takeout_end_index = sqs_body["takeout_end_index"]
+        report_queue_wait(sqs_body)
+        if sqs_body.get("speculative") and is_output_written(sqs_body): 
+            logger.info(f"Task {sqs_body['task_id']} already finished, skipping speculative copy")
+            release_pending_task(sqs_body)
+            return 
+        checkpoint_s3_key = get_checkpoint_s3_key(sqs_body, event["Records"][0]["messageId"])
+        checkpoint_s3_uri = f"s3://{s3_bucket}/{checkpoint_s3_key}"
+
+        # Subsets only contain the columns referenced by the script 
+        col_classes = None 
+        if sqs_body.get("dataset_id"): 
+            col_classes = get_r_col_classes(sqs_body["dataset_id"], sqs_body.get("columns"), drop_unused=False)
 
         # Compute local sensitivity 
-        output_df = get_local_sensitivities_df(script_s3_uri, subset_s3_uri, takeout_start_index, takeout_end_index)
-        write_worker_output_to_s3(output_df, sqs_body) 
+        if sqs_body.get("schedule") == "dynamic": 
+            output_df = get_dynamic_local_sensitivities_df(sqs_body, checkpoint_s3_uri, context, col_classes)
+        else: 
+            output_df = get_static_local_sensitivities_df(sqs_body, checkpoint_s3_uri, context, col_classes)
+        # A speculative copy that ran out of time leaves the task (and its 
+        # in-flight slot) to the original 
+        if output_df is None: 
+            return 
+
+        # Only the first copy of a task to finish writes its output. Every copy 
+        # frees the job's in-flight slot for its next pending task, in case the 
+        # copy that wrote the output didn't get to (only the first release counts). 
+        # A failed task doesn't release: the monitor fails its job 
+        if is_output_written(sqs_body): 
+            logger.info(f"Another copy of task {sqs_body['task_id']} already wrote its output")
+        else: 
+            write_worker_output_to_s3(output_df, sqs_body) 
+        release_pending_task(sqs_body)
+        delete_checkpoint(checkpoint_s3_key)
+        record_task_completed(sqs_body, int(output_df["rows_evaluated"].iloc[0]))
 
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -56,4 +371,9 @@ def lambda_handler(event, context):
             "stackTrace": traceback_string 
         })
         logger.error(err_msg)
+
+        # The message isn't retried, so let the monitor fail the job right away 
+        # (a speculative copy's failure is left to the original task) 
+        if sqs_body is not None and not sqs_body.get("speculative"): 
+            record_task_failed(sqs_body, exc_type.__name__)
         
\ No newline at end of file
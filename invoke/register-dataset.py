@@ -0,0 +1,13 @@
+import boto3
+import json
+import sys
+
+client = boto3.client("lambda")
+
+env = "-stg"
+
+# Register the datasets given on the command line (all datasets if none are given)
+payload = {"dataset_ids": sys.argv[1:]} if sys.argv[1:] else {}
+
+payload = json.dumps(payload).encode()
+response = client.invoke(FunctionName=f"sdt-validation-server-register{env}", InvocationType="Event", Payload=payload)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Lambda handlers import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+# Handlers read their bucket at import time (nothing in the tests calls AWS)
+os.environ.setdefault("S3_BUCKET_NAME", "test-bucket")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from claims import (
+    LocalCursorBackend,
+    compute_claim,
+    find_orphaned_claims,
+)
+
+NUM_WORKERS = 8
+
+
+def claim_until_exhausted(backend, cursor_id, claim_rows, claims, limit=None):
+    """
+    Claim chunks like a dynamic worker until the cursor is exhausted (or until
+    `limit` chunks were claimed, for a worker that dies).
+    """
+    while limit is None or len(claims) < limit:
+        claim = backend.claim(cursor_id, claim_rows)
+        if claim is None:
+            return
+        claims.append(claim)
+
+
+def claimed_rows(claims):
+    return sorted(i for start, end in claims for i in range(start, end + 1))
+
+
+@pytest.mark.parametrize("claimed, expected", [
+    (10, (1, 10)),
+    (100, (91, 100)),
+    (110, (101, 103)),
+    (120, None),
+])
+def test_compute_claim(claimed, expected):
+    assert compute_claim(claimed, 103, 10) == expected
+
+
+@pytest.mark.parametrize("max_index, claim_rows", [(100, 10), (103, 10), (7, 10), (1000, 3)])
+def test_concurrent_claims_cover_every_row_once(max_index, claim_rows):
+    backend = LocalCursorBackend()
+    backend.reset("job_0", max_index)
+    claims = [[] for _ in range(NUM_WORKERS)]
+    threads = [
+        threading.Thread(target=claim_until_exhausted, args=(backend, "job_0", claim_rows, worker_claims))
+        for worker_claims in claims
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert claimed_rows(c for worker_claims in claims for c in worker_claims) == list(range(1, max_index + 1))
+    assert backend.is_exhausted("job_0")
+
+
+def test_redelivered_worker_reclaims_orphaned_rows():
+    backend = LocalCursorBackend()
+    backend.reset("job_0", 103)
+
+    # The worker records 3 claims, checkpoints after the first and dies
+    died_claims = []
+    claim_until_exhausted(backend, "job_0", 10, died_claims, limit=3)
+    orphaned_claims = find_orphaned_claims(died_claims, 1, [])
+    assert orphaned_claims == died_claims[1:]
+
+    # Its redelivery takes out the orphaned claims while other workers keep claiming
+    claims = [list(orphaned_claims)] + [[] for _ in range(NUM_WORKERS - 1)]
+    threads = [
+        threading.Thread(target=claim_until_exhausted, args=(backend, "job_0", 10, worker_claims))
+        for worker_claims in claims
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    done_claims = died_claims[:1] + [c for worker_claims in claims for c in worker_claims]
+    assert claimed_rows(done_claims) == list(range(1, 104))
+
+
+def test_claims_handed_to_a_continuation_are_not_reclaimed():
+    claims = [(1, 10), (11, 20), (21, 30), (31, 40)]
+    spawned_messages = [{"task_id": "cps_0_w0_c0", "orphaned_claims": [[21, 30]]}]
+    assert find_orphaned_claims(claims, 1, spawned_messages) == [(11, 20), (31, 40)]
+
+
+def test_increment_counts_from_one():
+    backend = LocalCursorBackend()
+    assert [backend.increment("pool_cps") for _ in range(3)] == [1, 2, 3]
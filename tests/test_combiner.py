@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+from combiner import (
+    RowsEvaluatedMismatchException,
+    check_rows_evaluated,
+)
+
+
+def make_results(rows_evaluated):
+    """
+    Concatenated worker outputs (two statistics each), keyed by output like
+    get_worker_results().
+    """
+    df_list = [
+        pd.DataFrame({"stat_key": [0, 1], "n": [100, 100], "ls": [0.1, 0.2], "rows_evaluated": n, "stop_reason": "completed"})
+        for n in rows_evaluated
+    ]
+    return pd.concat(df_list, keys=range(len(df_list)))
+
+
+@pytest.mark.parametrize("scheduling_mode", ["static", "dynamic"])
+def test_complete_coverage_passes(scheduling_mode):
+    event = {"num_takeout_rows": 100, "sensitivity_mode": "exact", "scheduling_mode": scheduling_mode}
+    check_rows_evaluated(make_results([40, 40, 20]), event)
+
+
+@pytest.mark.parametrize("scheduling_mode", ["static", "dynamic"])
+def test_missing_rows_fail(scheduling_mode):
+    event = {"num_takeout_rows": 100, "sensitivity_mode": "exact", "scheduling_mode": scheduling_mode}
+    with pytest.raises(RowsEvaluatedMismatchException):
+        check_rows_evaluated(make_results([40, 40, 10]), event)
+
+
+def test_extra_rows_fail_only_dynamic_jobs():
+    results_df = make_results([40, 40, 30])
+    check_rows_evaluated(results_df, {"num_takeout_rows": 100, "sensitivity_mode": "exact", "scheduling_mode": "static"})
+    with pytest.raises(RowsEvaluatedMismatchException):
+        check_rows_evaluated(results_df, {"num_takeout_rows": 100, "sensitivity_mode": "exact", "scheduling_mode": "dynamic"})
+
+
+def test_approximate_jobs_are_not_checked():
+    event = {"num_takeout_rows": 100, "sensitivity_mode": "approximate", "scheduling_mode": "dynamic"}
+    check_rows_evaluated(make_results([5, 5]), event)
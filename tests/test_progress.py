@@ -0,0 +1,27 @@
+import pytest
+
+from progress import (
+    compute_in_flight_budgets,
+)
+
+
+def test_lone_job_uses_every_worker():
+    assert compute_in_flight_budgets({"a": ("low", 500)}, 100) == {"a": 100}
+
+
+def test_budgets_are_weighted_by_priority():
+    jobs = {"a": ("high", 500), "b": ("normal", 500), "c": ("low", 500)}
+    assert compute_in_flight_budgets(jobs, 70) == {"a": 40, "b": 20, "c": 10}
+
+
+def test_unused_share_is_lent_to_other_jobs():
+    jobs = {"small": ("high", 5), "large": ("low", 500)}
+    assert compute_in_flight_budgets(jobs, 100) == {"small": 5, "large": 95}
+
+
+@pytest.mark.parametrize("num_jobs", [1, 7, 150])
+def test_every_job_gets_a_slot(num_jobs):
+    jobs = {str(i): ("low", 500) for i in range(num_jobs)}
+    budgets = compute_in_flight_budgets(jobs, 100)
+    assert min(budgets.values()) >= 1
+    assert sum(budgets.values()) <= max(100, num_jobs)
@@ -0,0 +1,69 @@
+import glob
+import os
+
+import pytest
+
+from script_columns import (
+    find_script_columns,
+    uses_whole_data_frame,
+)
+
+COLUMNS = ["AGE", "INCWAGE", "MARST"]
+
+R_SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "r-scripts")
+
+
+def make_script(body):
+    return f"run_analysis <- function(df) {{\n    {body}\n    submit_output(x)\n}}\n"
+
+
+@pytest.mark.parametrize("body", [
+    "x <- na.omit(df)",
+    "x <- df[complete.cases(df), ]",
+    "x <- cor(df)",
+    "x <- sapply(df, mean)",
+    "x <- lapply(df, mean)",
+    "x <- df[1:3]",
+    "x <- df[df$AGE > 18, ]",
+    "x <- names(df)",
+    "x <- ncol(df)",
+    "x <- df |> na.omit()",
+    "x <- df %>% filter(AGE > 18) %>% na.omit()",
+    "x <- colMeans(filter(df, AGE > 18))",
+    "d <- df\n    x <- cor(d)",
+    "d <- df %>%\n        mutate(y = AGE * 2)\n    x <- summary(d)",
+    "v <- 'AGE'\n    x <- mean(df[[v]])",
+    "x <- lm(INCWAGE ~ ., data = df)",
+    "x <- lm(INCWAGE ~ AGE + ., data = df)",
+    "x <- glm(INCWAGE ~ AGE - 1 + ., data = df)",
+    "x <- df %>% lm(INCWAGE ~ AGE, data = .)",
+])
+def test_whole_data_frame_use_reads_all_columns(body):
+    assert find_script_columns(make_script(body), COLUMNS) is None
+
+
+@pytest.mark.parametrize("body, expected", [
+    ("x <- mean(df$AGE)", ["AGE"]),
+    ("x <- mean(df[['AGE']])", ["AGE"]),
+    ("x <- cor(df[c('AGE', 'INCWAGE')])", ["AGE", "INCWAGE"]),
+    ("x <- nrow(df) + mean(df$AGE)", ["AGE"]),
+    ("x <- lm(INCWAGE ~ AGE, data = df)", ["AGE", "INCWAGE"]),
+    ("x <- dplyr::filter(df, AGE > 18) %>% nrow()", ["AGE"]),
+    (
+        "d <- df %>%\n        filter(AGE > 18) %>%\n        mutate(z = INCWAGE + 1)\n"
+        "    x <- get_table_output(data = d, table_name = 't', stat = 'mean', var = 'z', by = 'MARST')",
+        ["AGE", "INCWAGE", "MARST"],
+    ),
+])
+def test_named_column_use_prunes_columns(body, expected):
+    assert find_script_columns(make_script(body), COLUMNS) == expected
+
+
+def test_script_without_run_analysis_reads_all_columns():
+    assert find_script_columns("x <- mean(AGE)", COLUMNS) is None
+
+
+@pytest.mark.parametrize("path", sorted(glob.glob(os.path.join(R_SCRIPTS_DIR, "cps-*.R"))))
+def test_example_scripts_use_named_columns(path):
+    with open(path) as f:
+        assert not uses_whole_data_frame(f.read())